@@ -0,0 +1,33 @@
+import json
+import os
+import threading
+from typing import Optional
+
+
+class BlobIndex:
+    """
+    Local index from file MD5 to the ID of the blob it was uploaded as.
+
+    Used by directory uploads to skip files whose exact contents were already uploaded. The index
+    is rewritten after every addition, so it survives the process being interrupted.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._blobs = {}
+        if os.path.exists(path):
+            with open(path) as index_file:
+                self._blobs = json.load(index_file)
+
+    def get(self, md5: str) -> Optional[dict]:
+        with self._lock:
+            return self._blobs.get(md5)
+
+    def add(self, md5: str, blob_id: str, name: str):
+        with self._lock:
+            self._blobs[md5] = {"blobId": blob_id, "name": name}
+            temp_path = "{}.tmp".format(self.path)
+            with open(temp_path, "w") as index_file:
+                json.dump(self._blobs, index_file, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
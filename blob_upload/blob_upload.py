@@ -1,31 +1,20 @@
-import json
+import glob
 import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import click
-import requests
+import threading
 import time
 
-from file_helpers import calculate_md5, encode_base64
+import api_client
+from api_client import api_post
+from blob_index import BlobIndex
+from file_helpers import ChunkReader, EncodedChunk, calculate_file_md5, calculate_md5, calculate_range_md5
+from part_sizing import AdaptivePartSizer
+from upload_journal import UploadJournal
 
 CHUNK_SIZE_BYTES = int(10e6)
-
-class BadRequestException(Exception):
-    def __init__(self, message, rv):
-        super(BadRequestException, self).__init__(message)
-        self.rv = rv
-
-
-def api_post(domain, api_key, path, body):
-    url = "https://{}/api/v2/{}".format(domain, path)
-    rv = requests.post(url, json=body, auth=(api_key, ""))
-    if rv.status_code >= 400:
-        raise BadRequestException(
-            "Server returned status {}. Response:\n{}".format(
-                rv.status_code, json.dumps(rv.json())
-            ),
-            rv,
-        )
-    return rv.json()
+JOURNAL_SUFFIX = ".upload-journal"
 
 
 @click.command()
@@ -35,32 +24,185 @@ def api_post(domain, api_key, path, body):
     required=True,
 )
 @click.option("--api-key", help="Your API key", required=True)
-@click.option("--filepath", help="Filepath of blob to upload", required=True)
+@click.option("--filepath", help="Filepath of blob to upload", required=False)
 @click.option("--destination-filename", help="Name of file (omit to keep same name as source)", required=False)
+@click.option(
+    "--directory",
+    help="Upload every file in this directory that matches --pattern, instead of a single --filepath",
+    type=click.Path(exists=True, file_okay=False),
+    required=False,
+)
+@click.option(
+    "--pattern",
+    help="Glob pattern of files to upload from --directory (use ** to include subdirectories)",
+    default="*",
+    show_default=True,
+)
+@click.option(
+    "--file-concurrency",
+    help="Number of files to upload in parallel from --directory",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+)
+@click.option(
+    "--index-file",
+    help=(
+        "Index of file MD5s to blob IDs, used to skip files that were already uploaded from --directory "
+        "(defaults to .blob_upload_index.json in the directory)"
+    ),
+    required=False,
+)
+@click.option(
+    "--concurrency",
+    help="Number of parts to upload in parallel for multi-part uploads",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+)
+@click.option(
+    "--resume",
+    help=(
+        "Record finished parts in a journal file instead of aborting the upload on failure, "
+        "and continue a previously interrupted upload of the same file"
+    ),
+    is_flag=True,
+)
+@click.option(
+    "--abort",
+    help="Abort the interrupted upload recorded in the journal file and delete the journal",
+    is_flag=True,
+)
+@click.option(
+    "--journal-file",
+    help="Path of the resume journal (defaults to the filepath with an .upload-journal suffix)",
+    required=False,
+)
+@click.option(
+    "--max-requests-per-second",
+    help="Client-side limit on API requests per second; set this to your tenant's API quota",
+    type=click.FloatRange(min=0, min_open=True),
+    default=api_client.DEFAULT_MAX_REQUESTS_PER_SECOND,
+    show_default=True,
+)
 def main(
         domain,
         api_key,
         filepath,
         destination_filename,
+        directory,
+        pattern,
+        file_concurrency,
+        index_file,
+        concurrency,
+        resume,
+        abort,
+        journal_file,
+        max_requests_per_second,
 ):
+    if (filepath is None) == (directory is None):
+        raise click.UsageError("Exactly one of --filepath or --directory is required")
+    api_client.configure(max_requests_per_second=max_requests_per_second)
+    if directory is not None:
+        if destination_filename or journal_file or abort:
+            raise click.UsageError(
+                "--destination-filename, --journal-file and --abort only apply to --filepath"
+            )
+        upload_directory(
+            api_key,
+            domain,
+            directory,
+            pattern,
+            index_file or os.path.join(directory, ".blob_upload_index.json"),
+            file_concurrency,
+            concurrency,
+            resume,
+        )
+        return
+
     name = destination_filename
     if name is None:
         name = os.path.basename(filepath)
+    journal_path = journal_file or "{}{}".format(filepath, JOURNAL_SUFFIX)
+    if abort:
+        abort_journaled_upload(api_key, domain, journal_path)
+        return
+    api_client.configure(pool_size=concurrency)
+    upload_file(api_key, domain, filepath, name, concurrency, journal_path if resume else None)
+
+
+def upload_file(api_key, domain, filepath, name, concurrency=1, journal_path=None):
+    """
+    Upload the file at `filepath` as a blob named `name`.
+
+    :returns: the ID of the uploaded blob
+    """
     file_size = os.path.getsize(filepath)
     with open(filepath, "rb") as file:
         if file_size <= CHUNK_SIZE_BYTES:
-            upload_single_part_blob(api_key, domain, file, name)
+            return upload_single_part_blob(api_key, domain, file, name)
         else:
-            upload_multi_part_blob(api_key, domain, file, name)
+            return upload_multi_part_blob(api_key, domain, file, name, concurrency, journal_path)
+
+
+def upload_directory(api_key, domain, directory, pattern, index_path, file_concurrency, concurrency, resume):
+    """
+    Upload every file in `directory` matching `pattern`, skipping files already in the index.
+    """
+    filepaths = sorted(
+        path
+        for path in glob.glob(os.path.join(directory, pattern), recursive=True)
+        if os.path.isfile(path)
+        and not path.endswith(JOURNAL_SUFFIX)
+        and os.path.abspath(path) != os.path.abspath(index_path)
+    )
+    blob_index = BlobIndex(index_path)
+    # Make sure there's a pooled connection for every part that can be in flight at once
+    api_client.configure(pool_size=file_concurrency * concurrency)
+    # MD5s of files being uploaded right now, so identical files in the same run are only sent once
+    uploading_md5s = set()
+    uploading_lock = threading.Lock()
+
+    def upload_if_new(filepath):
+        md5 = calculate_file_md5(filepath, CHUNK_SIZE_BYTES)
+        indexed_blob = blob_index.get(md5)
+        if indexed_blob is not None:
+            print("Skipping {}, already uploaded as blob {}".format(filepath, indexed_blob["blobId"]))
+            return
+        with uploading_lock:
+            if md5 in uploading_md5s:
+                print("Skipping {}, identical to a file being uploaded".format(filepath))
+                return
+            uploading_md5s.add(md5)
+        name = os.path.basename(filepath)
+        journal_path = "{}{}".format(filepath, JOURNAL_SUFFIX) if resume else None
+        blob_id = upload_file(api_key, domain, filepath, name, concurrency, journal_path)
+        blob_index.add(md5, blob_id, name)
+
+    failed_filepaths = []
+    with ThreadPoolExecutor(max_workers=file_concurrency) as executor:
+        futures = {executor.submit(upload_if_new, filepath): filepath for filepath in filepaths}
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print("Could not upload {}:\n{}".format(futures[future], e))
+                failed_filepaths.append(futures[future])
+    print("Finished {} of {} files from {}".format(
+        len(filepaths) - len(failed_filepaths), len(filepaths), directory
+    ))
+    if failed_filepaths:
+        raise click.ClickException("{} files could not be uploaded".format(len(failed_filepaths)))
 
 
 def upload_single_part_blob(api_key, domain, file, name):
-    file_contents = file.read()
-    encoded64 = encode_base64(file_contents)
-    md5 = calculate_md5(file_contents)
+    chunk = ChunkReader(file, CHUNK_SIZE_BYTES).read_chunk()
+    if chunk is None:
+        # An empty file has no chunks, so it's uploaded as an empty blob
+        chunk = EncodedChunk(offset=0, size=0, md5=calculate_md5(b""), data64="")
     res = api_post(domain, api_key, "blobs", {
-        "data64": encoded64,
-        "md5": md5,
+        "data64": chunk.data64,
+        "md5": chunk.md5,
         "mimeType": "application/octet-stream",
         "name": name,
         "type": "RAW_FILE",
@@ -69,39 +211,174 @@ def upload_single_part_blob(api_key, domain, file, name):
     print("Finished uploading {} with blob ID {}".format(
         res["name"], res["id"]
     ))
+    return res["id"]
+
+
+def upload_blob_part(api_key, domain, blob_id, part_number, encoded64, md5):
+    """
+    Upload one part of a multi-part blob.
+
+    :returns: a tuple of (created part, seconds taken to upload it)
+    """
+    started_at = time.monotonic()
+    # Uploading the same part number again just replaces it, so this is safe to retry
+    created_part = api_post(domain, api_key, "blobs/{}/parts".format(blob_id), {
+        "data64": encoded64,
+        "md5": md5,
+        "partNumber": part_number,
+    }, idempotent=True)
+    return created_part, time.monotonic() - started_at
+
 
+def collect_blob_parts(in_flight, done, blob_parts, part_sizer, journal=None):
+    for future in done:
+        part_number, offset, size, md5 = in_flight.pop(future)
+        try:
+            blob_parts[part_number], seconds = future.result()
+        except Exception as e:
+            e.part_number = part_number
+            raise
+        part_sizer.record_part(size, seconds)
+        if journal is not None:
+            journal.record_part(part_number, offset, size, md5, blob_parts[part_number])
+
+
+def resumed_part_size(journal, part_number, offset):
+    """
+    Return the size of part `part_number` when it has to fill a gap left by a previous run.
+
+    Parts after the gap were already uploaded at fixed offsets, so the missing parts must end
+    exactly where the next uploaded part starts. Returns None if no uploaded parts follow.
+    """
+    following_part_numbers = [number for number in journal.parts if number > part_number]
+    if not following_part_numbers:
+        return None
+    next_uploaded = min(following_part_numbers)
+    missing_parts = next_uploaded - part_number
+    gap = journal.parts[next_uploaded]["offset"] - offset
+    return -(-gap // missing_parts)
+
+
+def start_or_resume_multi_part_blob(api_key, domain, file, name, journal_path):
+    """
+    Start a multi-part upload, or pick up the one recorded in the journal at `journal_path`.
+
+    :returns: a tuple of (blob ID, journal). The journal is None when `journal_path` is None.
+    """
+    if journal_path is not None:
+        header = {
+            "name": name,
+            "fileSize": os.fstat(file.fileno()).st_size,
+        }
+        journal = UploadJournal.load(journal_path)
+        if journal is not None:
+            if not journal.matches(header):
+                raise click.ClickException(
+                    "Journal {} was written for a different upload. "
+                    "Rerun with --abort to discard it.".format(journal_path)
+                )
+            # The file may have been rewritten with the same size, so make sure the parts that
+            # were uploaded still match it
+            for part_number, entry in sorted(journal.parts.items()):
+                md5 = calculate_range_md5(file, entry["offset"], entry["size"], CHUNK_SIZE_BYTES)
+                if md5 != entry["md5"]:
+                    raise click.ClickException(
+                        "Part {} of {} has changed since it was uploaded. "
+                        "Rerun with --abort to discard the upload and start again.".format(part_number, name)
+                    )
+            file.seek(0)
+            print("Resuming blob {} with {} parts already uploaded".format(
+                journal.blob_id, len(journal.parts)
+            ))
+            return journal.blob_id, journal
 
-def upload_multi_part_blob(api_key, domain, file, name):
-    chunk_producer = lambda chunk_size: file.read(chunk_size)
     start_blob = api_post(domain, api_key, "blobs:start-multipart-upload", {
         "mimeType": "application/octet-stream",
         "name": name,
         "type": "RAW_FILE",
     })
+    if journal_path is None:
+        return start_blob["id"], None
+    return start_blob["id"], UploadJournal.create(journal_path, dict(header, blobId=start_blob["id"]))
+
+
+def abort_journaled_upload(api_key, domain, journal_path):
+    journal = UploadJournal.load(journal_path)
+    if journal is None:
+        raise click.ClickException("No upload journal found at {}".format(journal_path))
+    api_post(domain, api_key, "blobs/{}:abort-upload".format(journal.blob_id), {})
+    journal.delete()
+    print("Aborted upload of blob {}".format(journal.blob_id))
+
+
+def upload_multi_part_blob(api_key, domain, file, name, concurrency=1, journal_path=None):
+    chunk_reader = ChunkReader(file, CHUNK_SIZE_BYTES)
+    part_sizer = AdaptivePartSizer(os.fstat(file.fileno()).st_size, CHUNK_SIZE_BYTES)
+    blob_id, journal = start_or_resume_multi_part_blob(api_key, domain, file, name, journal_path)
     part_number = 0
-    blob_parts = []
+    blob_parts = {}
+    if journal is not None:
+        blob_parts.update({number: entry["part"] for number, entry in journal.parts.items()})
+    # Maps each in-flight upload to its part number, offset, size and MD5. At most `concurrency`
+    # parts are held in memory at once, since we only read the next chunk once a slot frees up.
+    in_flight = {}
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
     try:
         while True:
-            cursor = chunk_producer(CHUNK_SIZE_BYTES)
-            if not cursor:
+            if len(in_flight) >= concurrency:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect_blob_parts(in_flight, done, blob_parts, part_sizer, journal)
+            if journal is not None and part_number + 1 in journal.parts:
+                # Uploaded by a previous run, so skip over it without reading it
+                part_number += 1
+                chunk_reader.skip_chunk(journal.parts[part_number]["size"])
+                continue
+            offset = chunk_reader.offset
+            part_size = None
+            if journal is not None:
+                part_size = resumed_part_size(journal, part_number + 1, offset)
+            if part_size is None:
+                part_size = part_sizer.next_part_size(offset, part_number + 1)
+            # Encode and hash on this thread so the worker threads only wait on the network
+            chunk = chunk_reader.read_chunk(part_size)
+            if chunk is None:
                 break
             part_number += 1
-            encoded64 = encode_base64(cursor)
-            md5 = calculate_md5(cursor)
-            created_part = api_post(domain, api_key, "blobs/{}/parts".format(start_blob["id"]), {
-                "data64": encoded64,
-                "md5": md5,
-                "partNumber": part_number,
-            })
-            blob_parts.append(created_part)
-        api_post(domain, api_key, "blobs/{}:complete-upload".format(start_blob["id"]), {
-            "parts": blob_parts
+            future = executor.submit(
+                upload_blob_part, api_key, domain, blob_id, part_number, chunk.data64, chunk.md5
+            )
+            in_flight[future] = (part_number, chunk.offset, chunk.size, chunk.md5)
+            del chunk
+        collect_blob_parts(in_flight, wait(in_flight).done, blob_parts, part_sizer, journal)
+        api_post(domain, api_key, "blobs/{}:complete-upload".format(blob_id), {
+            # Parts may finish out of order, but must be completed in partNumber order
+            "parts": [blob_parts[number] for number in sorted(blob_parts)]
         })
-        print("Completed uploading {} parts for blob {}".format(part_number, start_blob["id"]))
+        print("Completed uploading {} parts for blob {}".format(len(blob_parts), blob_id))
+        if part_sizer.summary() is not None:
+            print(part_sizer.summary())
+        if chunk_reader.file_md5() is not None:
+            print("MD5 of uploaded file: {}".format(chunk_reader.file_md5()))
+        if journal is not None:
+            journal.delete()
+        return blob_id
     except Exception as e:
-        print("Error while uploading part {} for blob {}".format(part_number, start_blob["id"]))
-        api_post(domain, api_key, "blobs/{}:abort-upload".format(start_blob["id"]), {})
+        print("Error while uploading part {} for blob {}".format(
+            getattr(e, "part_number", part_number), blob_id
+        ))
+        executor.shutdown(wait=True, cancel_futures=True)
+        if journal is not None:
+            # Collect parts that finished while we were shutting down, so they aren't re-sent
+            for future in list(in_flight):
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    collect_blob_parts(in_flight, [future], blob_parts, part_sizer, journal)
+            print("Rerun with --resume to continue this upload, or with --abort to discard it")
+        else:
+            api_post(domain, api_key, "blobs/{}:abort-upload".format(blob_id), {})
         raise e
+    finally:
+        executor.shutdown(wait=True)
 
 if __name__ == "__main__":
     main()
@@ -1,11 +1,104 @@
 import base64
 import hashlib
+import os
+from typing import BinaryIO, NamedTuple, Optional
 
 
 def encode_base64(input: bytes, charset: str = "utf-8") -> str:
-    file_bytes = base64.encodebytes(input)
+    file_bytes = base64.b64encode(input)
     return str(file_bytes, charset)
 
 
 def calculate_md5(input: bytes) -> str:
     return hashlib.md5(input).hexdigest()
+
+
+def calculate_file_md5(path: str, chunk_size: int) -> str:
+    md5 = hashlib.md5()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, "rb") as file:
+        while True:
+            read = file.readinto(buffer)
+            if not read:
+                break
+            md5.update(view[:read])
+    return md5.hexdigest()
+
+
+def calculate_range_md5(file: BinaryIO, offset: int, size: int, chunk_size: int) -> str:
+    """Return the MD5 of `size` bytes of `file` from `offset`, or fewer if the file ends first."""
+    md5 = hashlib.md5()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    file.seek(offset)
+    remaining = size
+    while remaining > 0:
+        read = file.readinto(view[:min(remaining, chunk_size)])
+        if not read:
+            break
+        md5.update(view[:read])
+        remaining -= read
+    return md5.hexdigest()
+
+
+class EncodedChunk(NamedTuple):
+    offset: int
+    size: int
+    md5: str
+    data64: str
+
+
+class ChunkReader:
+    """
+    Reads a file in chunks ready to be sent as blob parts.
+
+    Every chunk is read into the same buffer, so the only per-chunk allocation is the base64
+    payload itself. The MD5 of the whole file is updated as chunks are read, as long as none
+    are skipped.
+    """
+
+    def __init__(self, file: BinaryIO, chunk_size: int):
+        self.chunk_size = chunk_size
+        self._file = file
+        self._buffer = bytearray(chunk_size)
+        self._view = memoryview(self._buffer)
+        self._file_md5 = hashlib.md5()
+        self._skipped_chunks = False
+
+    @property
+    def offset(self) -> int:
+        return self._file.tell()
+
+    def read_chunk(self, size: Optional[int] = None) -> Optional[EncodedChunk]:
+        size = size or self.chunk_size
+        if size > len(self._buffer):
+            self._buffer = bytearray(size)
+            self._view = memoryview(self._buffer)
+        offset = self._file.tell()
+        read_size = 0
+        while read_size < size:
+            read = self._file.readinto(self._view[read_size:size])
+            if not read:
+                break
+            read_size += read
+        if read_size == 0:
+            return None
+        chunk = self._view[:read_size]
+        self._file_md5.update(chunk)
+        return EncodedChunk(
+            offset=offset,
+            size=read_size,
+            md5=hashlib.md5(chunk).hexdigest(),
+            data64=str(base64.b64encode(chunk), "ascii"),
+        )
+
+    def skip_chunk(self, size: Optional[int] = None):
+        self._file.seek(size or self.chunk_size, os.SEEK_CUR)
+        self._skipped_chunks = True
+
+    def file_md5(self) -> Optional[str]:
+        """Return the MD5 of everything read so far, or None if any chunks were skipped."""
+        if self._skipped_chunks:
+            return None
+        return self._file_md5.hexdigest()
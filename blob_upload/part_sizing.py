@@ -0,0 +1,76 @@
+import math
+import time
+from typing import Optional
+
+# Every part except the last must be at least 5 MB, and a blob can have at most 10,000 parts.
+MIN_PART_SIZE_BYTES = int(5e6)
+MAX_PART_SIZE_BYTES = int(50e6)
+MAX_PART_COUNT = 10000
+
+# Aim for parts that take about this long to upload: long enough that per-request overhead is
+# small, short enough that retrying a failed part doesn't cost much.
+TARGET_PART_SECONDS = 10.0
+# Aim for at most this many parts when picking the initial size from the file size.
+TARGET_PART_COUNT = 1000
+# Weight given to the newest throughput measurement when averaging.
+THROUGHPUT_SMOOTHING = 0.3
+
+
+class AdaptivePartSizer:
+    """
+    Chooses multi-part upload part sizes from the file size and the measured upload throughput.
+
+    The first parts are sized so a file takes about TARGET_PART_COUNT parts. After that, the part
+    size follows a moving average of the per-part throughput, so that each part takes about
+    TARGET_PART_SECONDS to upload. Sizes always stay within the API's bounds.
+    """
+
+    def __init__(self, file_size: int, default_part_size: int):
+        self.file_size = file_size
+        self.part_size = clamp_part_size(max(default_part_size, math.ceil(file_size / TARGET_PART_COUNT)))
+        self.min_part_size_used = None
+        self.max_part_size_used = None
+        self.bytes_uploaded = 0
+        self._throughput = None
+        self._started_at = time.monotonic()
+
+    def next_part_size(self, offset: int, part_number: int) -> int:
+        """Return the size of part `part_number`, which starts at byte `offset`."""
+        # Never pick a size that would need more parts than the API allows for the rest of the file
+        parts_left = MAX_PART_COUNT - part_number + 1
+        min_size = math.ceil((self.file_size - offset) / parts_left)
+        size = max(self.part_size, min_size)
+        self.min_part_size_used = min(size, self.min_part_size_used or size)
+        self.max_part_size_used = max(size, self.max_part_size_used or size)
+        return size
+
+    def record_part(self, size: int, seconds: float):
+        self.bytes_uploaded += size
+        throughput = size / max(seconds, 1e-3)
+        if self._throughput is None:
+            self._throughput = throughput
+        else:
+            self._throughput = (
+                THROUGHPUT_SMOOTHING * throughput + (1 - THROUGHPUT_SMOOTHING) * self._throughput
+            )
+        # Change the size gradually, so one unusually fast or slow part doesn't swing it too far
+        target_size = self._throughput * TARGET_PART_SECONDS
+        self.part_size = clamp_part_size(
+            int(min(max(target_size, self.part_size / 2), self.part_size * 2))
+        )
+
+    def summary(self) -> Optional[str]:
+        if self.min_part_size_used is None:
+            return None
+        seconds = time.monotonic() - self._started_at
+        return "Used part sizes of {:.1f}-{:.1f} MB (last chosen {:.1f} MB); uploaded {:.1f} MB at {:.2f} MB/s".format(
+            self.min_part_size_used / 1e6,
+            self.max_part_size_used / 1e6,
+            self.part_size / 1e6,
+            self.bytes_uploaded / 1e6,
+            self.bytes_uploaded / 1e6 / max(seconds, 1e-3),
+        )
+
+
+def clamp_part_size(size: int) -> int:
+    return min(max(size, MIN_PART_SIZE_BYTES), MAX_PART_SIZE_BYTES)
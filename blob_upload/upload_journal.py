@@ -0,0 +1,72 @@
+import json
+import os
+from typing import Optional
+
+
+class UploadJournal:
+    """
+    Append-only record of a resumable multi-part blob upload.
+
+    The first line holds the blob ID and the parameters the upload was started with, and each
+    following line records a part that finished uploading. Only complete lines are trusted, so a
+    crash while writing a line just means that part is uploaded again on resume.
+    """
+
+    def __init__(self, path: str, header: dict, parts: dict):
+        self.path = path
+        self.header = header
+        self.parts = parts
+
+    @property
+    def blob_id(self) -> str:
+        return self.header["blobId"]
+
+    @classmethod
+    def create(cls, path: str, header: dict) -> "UploadJournal":
+        journal = cls(path, header, {})
+        with open(path, "w") as journal_file:
+            journal._write_line(journal_file, header)
+        return journal
+
+    @classmethod
+    def load(cls, path: str) -> Optional["UploadJournal"]:
+        if not os.path.exists(path):
+            return None
+        header = None
+        parts = {}
+        with open(path) as journal_file:
+            for line in journal_file:
+                if not line.endswith("\n"):
+                    break
+                entry = json.loads(line)
+                if header is None:
+                    header = entry
+                else:
+                    parts[entry["partNumber"]] = entry
+        if header is None:
+            return None
+        return cls(path, header, parts)
+
+    def matches(self, header: dict) -> bool:
+        return all(self.header.get(key) == value for key, value in header.items())
+
+    def record_part(self, part_number: int, offset: int, size: int, md5: str, part: dict):
+        entry = {
+            "partNumber": part_number,
+            "offset": offset,
+            "size": size,
+            "md5": md5,
+            "part": part,
+        }
+        with open(self.path, "a") as journal_file:
+            self._write_line(journal_file, entry)
+        self.parts[part_number] = entry
+
+    def delete(self):
+        os.remove(self.path)
+
+    @staticmethod
+    def _write_line(journal_file, entry: dict):
+        journal_file.write(json.dumps(entry) + "\n")
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
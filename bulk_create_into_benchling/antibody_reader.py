@@ -0,0 +1,174 @@
+# Streams antibodies out of an import file without loading the whole file into memory.
+#
+# Two layouts are supported:
+# - an object with an "antibodies" array, like antibodies.json, whose elements are parsed one at a
+#   time. Other keys of the object are skipped.
+# - JSON Lines, with one antibody object per line
+import json
+import re
+
+import click
+
+READ_SIZE = 64 * 1024
+WHITESPACE = re.compile(r"\s*")
+
+
+def iter_antibody_batches(file, batch_size):
+    """
+    Yield lists of at most `batch_size` antibodies, in file order.
+    """
+    batch = []
+    for antibody_obj in iter_antibodies(file):
+        batch.append(antibody_obj)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_antibodies(file):
+    buffer = file.read(READ_SIZE)
+    position = WHITESPACE.match(buffer).end()
+    if buffer.startswith("{", position):
+        buffer, position = find_antibodies_array(file, buffer, position)
+        if position is not None:
+            return iter_antibodies_array(file, buffer, position)
+    return iter_json_lines(file, buffer)
+
+
+def find_antibodies_array(file, buffer, position):
+    """
+    Look through the keys of the object starting at `position` for the "antibodies" array, reading
+    more of the file as needed.
+
+    :returns: the buffer, with everything read so far, and the position just inside the array, or
+        None if the object has no "antibodies" key, as in a JSON Lines file
+    """
+    decoder = json.JSONDecoder()
+
+    def read_more():
+        nonlocal buffer
+        more = file.read(READ_SIZE)
+        buffer += more
+        return more != ""
+
+    def skip_whitespace(position):
+        while True:
+            position = WHITESPACE.match(buffer, position).end()
+            if position < len(buffer) or not read_more():
+                return position
+
+    def decode(position):
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if not read_more():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next read
+            if end == len(buffer) and read_more():
+                continue
+            return value, end
+
+    position += 1
+    while True:
+        position = skip_whitespace(position)
+        if buffer.startswith("}", position):
+            return buffer, None
+        try:
+            key, position = decode(position)
+            position = skip_whitespace(position)
+            if not isinstance(key, str) or not buffer.startswith(":", position):
+                return buffer, None
+            position = skip_whitespace(position + 1)
+            if key == "antibodies":
+                if not buffer.startswith("[", position):
+                    raise click.ClickException('"antibodies" must be an array of antibodies')
+                return buffer, position + 1
+            _, position = decode(position)
+        except json.JSONDecodeError:
+            # Not a well-formed object, so leave it to the JSON Lines parser to report
+            return buffer, None
+        position = skip_whitespace(position)
+        if not buffer.startswith(",", position):
+            return buffer, None
+        position += 1
+
+
+def iter_antibodies_array(file, buffer, position):
+    """Incrementally decode the elements of the "antibodies" array, reading more as needed."""
+    decoder = json.JSONDecoder()
+    at_end_of_file = False
+    expect_value = True
+    while True:
+        position = WHITESPACE.match(buffer, position).end()
+        if position == len(buffer):
+            if at_end_of_file:
+                raise click.ClickException("Unexpected end of file in the antibodies array")
+            buffer = file.read(READ_SIZE)
+            at_end_of_file = buffer == ""
+            position = 0
+            continue
+
+        if buffer[position] == "]":
+            return
+        if not expect_value:
+            if buffer[position] != ",":
+                raise click.ClickException(
+                    "Expected ',' or ']' in the antibodies array, found {!r}".format(
+                        buffer[position:position + 20]
+                    )
+                )
+            position += 1
+            expect_value = True
+            continue
+
+        try:
+            antibody_obj, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as e:
+            if at_end_of_file:
+                raise click.ClickException("Invalid antibody in the antibodies array: {}".format(e))
+            # The element is probably cut off at the end of the buffer, so drop what's been parsed
+            # and read some more
+            more = file.read(READ_SIZE)
+            at_end_of_file = more == ""
+            buffer = buffer[position:] + more
+            position = 0
+            continue
+        expect_value = False
+        yield antibody_obj
+
+
+def iter_json_lines(file, first_chunk):
+    line_number = 0
+    partial_line = ""
+    chunk = first_chunk
+    while chunk:
+        lines = (partial_line + chunk).split("\n")
+        partial_line = lines.pop()
+        for line in lines:
+            line_number += 1
+            antibody_obj = parse_json_line(line, line_number)
+            if antibody_obj is not None:
+                yield antibody_obj
+        chunk = file.read(READ_SIZE)
+    antibody_obj = parse_json_line(partial_line, line_number + 1)
+    if antibody_obj is not None:
+        yield antibody_obj
+
+
+def parse_json_line(line, line_number):
+    if not line.strip():
+        return None
+    try:
+        antibody_obj = json.loads(line)
+    except ValueError as e:
+        raise click.ClickException("Invalid JSON on line {}: {}".format(line_number, e))
+    if not isinstance(antibody_obj, dict) or "name" not in antibody_obj:
+        raise click.ClickException(
+            'Line {} is not an antibody object with a "name", and the file has no "antibodies" '
+            "array".format(line_number)
+        )
+    return antibody_obj
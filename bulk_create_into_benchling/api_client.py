@@ -0,0 +1,169 @@
+# Client for Benchling's API shared by the scripts in this directory.
+#
+# Every request goes through one pooled requests.Session so connections are reused, is paced by
+# a client-side rate limiter, times out if the connection stalls, and is retried with exponential
+# backoff when Benchling asks us to slow down (429) or has a temporary failure (5xx).
+import datetime
+import email.utils
+import json
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+MAX_RETRIES = 5
+BASE_BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 60.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Set this to your tenant's API quota with configure(max_requests_per_second=...)
+DEFAULT_MAX_REQUESTS_PER_SECOND = 10.0
+DEFAULT_POOL_SIZE = 10
+# Seconds to wait for a connection, and for the server to send data once connected
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 10.0
+DEFAULT_READ_TIMEOUT_SECONDS = 120.0
+
+
+class BadRequestException(Exception):
+    def __init__(self, message, rv):
+        super(BadRequestException, self).__init__(message)
+        self.rv = rv
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: allows bursts of up to `capacity` requests, and `rate` requests
+    per second on average.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            # Take the token now, even if that leaves the bucket in debt, and wait outside the lock
+            self._tokens -= 1
+            wait_seconds = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_maxsize=DEFAULT_POOL_SIZE))
+rate_limiter = TokenBucket(DEFAULT_MAX_REQUESTS_PER_SECOND)
+timeout = (DEFAULT_CONNECT_TIMEOUT_SECONDS, DEFAULT_READ_TIMEOUT_SECONDS)
+
+
+def configure(max_requests_per_second=None, pool_size=None, connect_timeout=None, read_timeout=None):
+    """
+    Change the client-wide request rate limit, the number of pooled connections, or the timeouts.
+
+    The pool should be at least as large as the number of threads making requests at once.
+    """
+    global rate_limiter, timeout
+    if max_requests_per_second is not None:
+        rate_limiter = TokenBucket(max_requests_per_second)
+    if pool_size is not None:
+        session.mount("https://", HTTPAdapter(pool_maxsize=pool_size))
+    if connect_timeout is not None or read_timeout is not None:
+        timeout = (
+            connect_timeout if connect_timeout is not None else timeout[0],
+            read_timeout if read_timeout is not None else timeout[1],
+        )
+
+
+def backoff_seconds(attempt, rv=None):
+    """
+    Return how long to wait before retry number `attempt` (starting at 0).
+
+    Uses exponential backoff with full jitter, but never waits less than the server's Retry-After.
+    """
+    seconds = random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** attempt))
+    retry_after = rv.headers.get("Retry-After") if rv is not None else None
+    if retry_after:
+        try:
+            seconds = max(seconds, float(retry_after))
+        except ValueError:
+            seconds = max(seconds, seconds_until_http_date(retry_after))
+    return seconds
+
+
+def seconds_until_http_date(value):
+    """Return the seconds until an HTTP date such as a Retry-After header, or 0 if it's invalid."""
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        # Python 3.7 raises TypeError for dates it can't parse, and later versions ValueError
+        return 0
+    if retry_at.tzinfo is None:
+        # A "-0000" offset gives a naive datetime, but HTTP dates are always in UTC
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return retry_at.timestamp() - time.time()
+
+
+def request(method, domain, api_key, path, params=None, body=None, headers=None, idempotent=True):
+    """
+    Send a request to Benchling's API, retrying rate-limited and failed requests.
+
+    Requests that aren't `idempotent` are only retried when they were rate limited or couldn't
+    connect, since the server did not process them; other failures might have had an effect, so
+    they are returned or raised.
+
+    :returns: the final requests.Response, whatever its status
+    """
+    url = "https://{}/api/v2/{}".format(domain, path)
+    attempt = 0
+    while True:
+        rate_limiter.acquire()
+        try:
+            rv = session.request(
+                method,
+                url,
+                params=params,
+                json=body,
+                headers=headers,
+                auth=(api_key, ""),
+                timeout=timeout,
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= MAX_RETRIES or (not idempotent and not isinstance(e, requests.ConnectTimeout)):
+                raise
+            rv = None
+        else:
+            if rv.status_code not in RETRYABLE_STATUS_CODES or attempt >= MAX_RETRIES:
+                return rv
+            if not idempotent and rv.status_code != 429:
+                return rv
+        time.sleep(backoff_seconds(attempt, rv))
+        attempt += 1
+
+
+def raise_for_status(rv):
+    if rv.status_code >= 400:
+        raise BadRequestException(
+            "Server returned status {}. Response:\n{}".format(
+                rv.status_code, json.dumps(rv.json())
+            ),
+            rv,
+        )
+
+
+def api_get(domain, api_key, path, params=None):
+    rv = request("GET", domain, api_key, path, params=params)
+    raise_for_status(rv)
+    return rv.json()
+
+
+def api_post(domain, api_key, path, body, idempotent=False):
+    rv = request("POST", domain, api_key, path, body=body, idempotent=idempotent)
+    raise_for_status(rv)
+    return rv.json()
@@ -1,54 +1,25 @@
-import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import click
-import requests
-import time
 
+import api_client
+from antibody_reader import iter_antibody_batches
+from api_client import api_post
+from run_manifest import RunManifest
+from task_watcher import DEFAULT_TIMEOUT_SECONDS, TaskWatcher
 
-class BadRequestException(Exception):
-    def __init__(self, message, rv):
-        super(BadRequestException, self).__init__(message)
-        self.rv = rv
 
-
-def api_get(domain, api_key, path):
-    url = "https://{}/api/v2/{}".format(domain, path)
-    rv = requests.get(url, auth=(api_key, ""))
-    if rv.status_code >= 400:
-        raise BadRequestException(
-            "Server returned status {}. Response:\n{}".format(
-                rv.status_code, json.dumps(rv.json())
-            ),
-            rv,
-        )
-    return rv.json()
-
-
-def api_post(domain, api_key, path, body):
-    url = "https://{}/api/v2/{}".format(domain, path)
-    rv = requests.post(url, json=body, auth=(api_key, ""))
-    if rv.status_code >= 400:
-        raise BadRequestException(
-            "Server returned status {}. Response:\n{}".format(
-                rv.status_code, json.dumps(rv.json())
-            ),
-            rv,
-        )
-    return rv.json()
+def run_bulk_create_task(domain, api_key, task_watcher, path, body):
+    task_resource = api_post(domain, api_key, path, body)
+    return task_watcher.wait(task_resource)
 
 
-def wait_on_task_response(domain, api_key, task_resource):
-    task_id = task_resource["taskId"]
-    while True:
-        task_response = api_get(domain, api_key, "tasks/{}".format(task_id))
-        status = task_response["status"]
-        if status == "RUNNING":
-            time.sleep(10)
-        else:
-            if status == "FAILED":
-                return "FAILED", task_response["message"], task_response["errors"]
-            elif status == "SUCCEEDED":
-                return "SUCCEEDED", task_response["response"]
+def antibody_inputs(heavy_chain_obj, light_chain_obj):
+    return {
+        "Heavy Chain": heavy_chain_obj["entityRegistryId"],
+        "Light Chain": light_chain_obj["entityRegistryId"],
+    }
 
 
 @click.command()
@@ -68,6 +39,42 @@ def wait_on_task_response(domain, api_key, task_resource):
     help="ID of the Chain schema (Must be an AA-Sequence)",
     required=True,
 )
+@click.option(
+    "--max-requests-per-second",
+    help="Client-side limit on API requests per second; set this to your tenant's API quota",
+    type=click.FloatRange(min=0.01),
+    default=api_client.DEFAULT_MAX_REQUESTS_PER_SECOND,
+    show_default=True,
+)
+@click.option(
+    "--batch-size",
+    help="Number of antibodies to register in each bulk-create task",
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+)
+@click.option(
+    "--concurrency",
+    help="Number of bulk-create tasks to run at once",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+)
+@click.option(
+    "--task-timeout",
+    help="Seconds to wait for each bulk-create task to finish before reporting it as failed",
+    type=click.FloatRange(min=0),
+    default=DEFAULT_TIMEOUT_SECONDS,
+    show_default=True,
+)
+@click.option(
+    "--manifest-file",
+    help=(
+        "File to record registered entities in. Rerunning an import with the same manifest "
+        "only registers the chains and antibodies that weren't registered yet"
+    ),
+    type=click.Path(dir_okay=False),
+)
 @click.argument("json_file_to_import", type=click.File("r"))
 def main(
     domain,
@@ -76,130 +83,228 @@ def main(
     registry_id,
     chain_schema_id,
     folder_id,
+    max_requests_per_second,
+    batch_size,
+    concurrency,
+    task_timeout,
+    manifest_file,
     json_file_to_import,
 ):
-    antibodies_obj = json.loads(json_file_to_import.read())
-    antibody_objs = antibodies_obj["antibodies"]
-
-    # Bulk create heavy chains into registry.
-    task_resource = api_post(
-        domain,
-        api_key,
-        # https://docs.benchling.com/reference#bulk-create-aa-sequences
-        "aa-sequences:bulk-create",
+    api_client.configure(max_requests_per_second=max_requests_per_second, pool_size=2 * concurrency)
+    # Polls every running bulk-create task from one loop
+    task_watcher = TaskWatcher(domain, api_key, timeout_seconds=task_timeout)
+
+    run_manifest = RunManifest(
         {
-            "aaSequences": [
-                {
-                    "aminoAcids": antibody_obj["Heavy Chain"],
-                    "folderId": folder_id,
-                    "name": "Heavy Chain for {}".format(antibody_obj["name"]),
-                    "schemaId": chain_schema_id,
-                    "registryId": registry_id,
-                    "namingStrategy": "NEW_IDS",
-                }
-                for antibody_obj in antibody_objs
-            ]
+            "registryId": registry_id,
+            "folderId": folder_id,
+            "antibodySchemaId": antibody_schema_id,
+            "chainSchemaId": chain_schema_id,
         },
+        manifest_file,
     )
-    task_response = wait_on_task_response(domain, api_key, task_resource)
-    if task_response[0] == "FAILED":
-        print(
-            "Could not register at least one heavy chain. Error response from server:\n{}\n{}".format(
-                task_response[1],
-                task_response[2],
+
+    def register_chains(antibody_obj_batch, chain_field):
+        """
+        Register the chains of the antibodies that don't have one in the manifest yet.
+
+        :returns: the registered chain of each antibody by name, and the failed task response
+            if registering the remaining chains failed
+        """
+        chain_objs = {}
+        unregistered_antibody_objs = []
+        for antibody_obj in antibody_obj_batch:
+            chain_obj = run_manifest.get(
+                antibody_obj["name"], chain_field, {"aminoAcids": antibody_obj[chain_field]}
             )
+            if chain_obj is None:
+                unregistered_antibody_objs.append(antibody_obj)
+            else:
+                chain_objs[antibody_obj["name"]] = chain_obj
+        if not unregistered_antibody_objs:
+            return chain_objs, None
+
+        task_response = run_bulk_create_task(
+            domain,
+            api_key,
+            task_watcher,
+            # https://docs.benchling.com/reference#bulk-create-aa-sequences
+            "aa-sequences:bulk-create",
+            {
+                "aaSequences": [
+                    {
+                        "aminoAcids": antibody_obj[chain_field],
+                        "folderId": folder_id,
+                        "name": "{} for {}".format(chain_field, antibody_obj["name"]),
+                        "schemaId": chain_schema_id,
+                        "registryId": registry_id,
+                        "namingStrategy": "NEW_IDS",
+                    }
+                    for antibody_obj in unregistered_antibody_objs
+                ]
+            },
         )
-        return
+        if task_response[0] == "FAILED":
+            return chain_objs, task_response
+        registered = [
+            (antibody_obj["name"], {"aminoAcids": antibody_obj[chain_field]}, chain_obj)
+            for antibody_obj, chain_obj in zip(
+                unregistered_antibody_objs, task_response[1]["aaSequences"]
+            )
+        ]
+        run_manifest.record(chain_field, registered)
+        chain_objs.update((antibody_name, chain_obj) for antibody_name, _, chain_obj in registered)
+        return chain_objs, None
 
-    bulk_registered_heavy_chain_response_obj = task_response[1]["aaSequences"]
-    print("Successfully registered heavy chains")
+    def register_antibodies(batch_number, antibody_obj_batch):
+        """
+        Register one batch of antibodies and their chains, skipping what the manifest says
+        is already registered.
 
-    # Bulk create light chains into registry.
-    task_resource = api_post(
-        domain,
-        api_key,
-        # https://docs.benchling.com/reference#bulk-create-aa-sequences
-        "aa-sequences:bulk-create",
-        {
-            "aaSequences": [
-                {
-                    "aminoAcids": antibody_obj["Light Chain"],
-                    "folderId": folder_id,
-                    "name": "Light Chain for {}".format(antibody_obj["name"]),
-                    "schemaId": chain_schema_id,
-                    "registryId": registry_id,
-                    "namingStrategy": "NEW_IDS",
-                }
-                for antibody_obj in antibody_objs
-            ]
-        },
-    )
-
-    task_response = wait_on_task_response(domain, api_key, task_resource)
-    if task_response[0] == "FAILED":
-        print(
-            "Could not register at least one light chain. Error response from server:\n{}\n{}".format(
+        :returns: the lines to print for the batch, and how many of its antibodies are registered
+        """
+        # Bulk create heavy and light chains into registry. They don't depend on each other,
+        # so they're registered at the same time.
+        light_chain_future = chain_executor.submit(register_chains, antibody_obj_batch, "Light Chain")
+        heavy_chain_objs, failed_heavy_chain_task_response = register_chains(
+            antibody_obj_batch, "Heavy Chain"
+        )
+        light_chain_objs, failed_light_chain_task_response = light_chain_future.result()
+        output_lines = [
+            "Could not register at least one {} chain in batch {}. Error response from server:\n{}\n{}".format(
+                chain_type,
+                batch_number,
                 task_response[1],
                 task_response[2],
             )
-        )
-        return
+            for chain_type, task_response in (
+                ("heavy", failed_heavy_chain_task_response),
+                ("light", failed_light_chain_task_response),
+            )
+            if task_response is not None
+        ]
+        if not output_lines:
+            output_lines.append(
+                "Successfully registered heavy and light chains for batch {}".format(batch_number)
+            )
 
-    bulk_registered_light_chain_response_obj = task_response[1]["aaSequences"]
-    print("Successfully registered light chains")
+        # Bulk create the antibodies whose chains are both registered, and which aren't
+        # registered themselves yet.
+        antibodies_with_chains = []
+        for antibody_obj in antibody_obj_batch:
+            heavy_chain_obj = heavy_chain_objs.get(antibody_obj["name"])
+            light_chain_obj = light_chain_objs.get(antibody_obj["name"])
+            if heavy_chain_obj is not None and light_chain_obj is not None:
+                antibodies_with_chains.append((antibody_obj, heavy_chain_obj, light_chain_obj))
+        registered_antibodies = []
+        unregistered_antibodies = []
+        for antibody_obj, heavy_chain_obj, light_chain_obj in antibodies_with_chains:
+            registered_antibody_obj = run_manifest.get(
+                antibody_obj["name"],
+                "Antibody",
+                antibody_inputs(heavy_chain_obj, light_chain_obj),
+            )
+            if registered_antibody_obj is None:
+                unregistered_antibodies.append((antibody_obj, heavy_chain_obj, light_chain_obj))
+            else:
+                registered_antibodies.append(
+                    (registered_antibody_obj, heavy_chain_obj, light_chain_obj)
+                )
+                output_lines.append(
+                    "Already registered Antibody {} with Heavy Chain {} and Light Chain {}".format(
+                        registered_antibody_obj["entityRegistryId"],
+                        heavy_chain_obj["entityRegistryId"],
+                        light_chain_obj["entityRegistryId"],
+                    )
+                )
+        if not unregistered_antibodies:
+            return output_lines, len(registered_antibodies)
 
-    # Bulk create antibodies in registry.
-    task_resource = api_post(
-        domain,
-        api_key,
-        # https://docs.benchling.com/reference#bulk-create-custom-entities
-        "custom-entities:bulk-create",
-        {
-            "customEntities": [
-                {
-                    "name": antibody_obj["name"],
-                    "schemaId": antibody_schema_id,
-                    "folderId": folder_id,
-                    "registryId": registry_id,
-                    "namingStrategy": "NEW_IDS",
-                    "fields": {
-                        "Heavy Chain": {"value": heavy_chain_obj["entityRegistryId"]},
-                        "Light Chain": {"value": light_chain_obj["entityRegistryId"]},
-                    },
-                }
-                for antibody_obj, heavy_chain_obj, light_chain_obj in zip(
-                    antibody_objs,
-                    bulk_registered_heavy_chain_response_obj,
-                    bulk_registered_light_chain_response_obj,
+        task_response = run_bulk_create_task(
+            domain,
+            api_key,
+            task_watcher,
+            # https://docs.benchling.com/reference#bulk-create-custom-entities
+            "custom-entities:bulk-create",
+            {
+                "customEntities": [
+                    {
+                        "name": antibody_obj["name"],
+                        "schemaId": antibody_schema_id,
+                        "folderId": folder_id,
+                        "registryId": registry_id,
+                        "namingStrategy": "NEW_IDS",
+                        "fields": {
+                            "Heavy Chain": {"value": heavy_chain_obj["entityRegistryId"]},
+                            "Light Chain": {"value": light_chain_obj["entityRegistryId"]},
+                        },
+                    }
+                    for antibody_obj, heavy_chain_obj, light_chain_obj in unregistered_antibodies
+                ]
+            },
+        )
+        if task_response[0] == "FAILED":
+            output_lines.append(
+                "Could not register at least one antibody in batch {}. Error response from server:\n{}\n{}".format(
+                    batch_number,
+                    task_response[1],
+                    task_response[2],
                 )
-            ]
-        },
-    )
-    task_response = wait_on_task_response(domain, api_key, task_resource)
-    if task_response[0] == "FAILED":
-        print(
-            "Could not register at least one antibody. Error response from server:\n{}\n{}".format(
-                task_response[1],
-                task_response[2],
             )
+            return output_lines, len(registered_antibodies)
+
+        bulk_registered_antibody_response_obj = task_response[1]["customEntities"]
+        run_manifest.record(
+            "Antibody",
+            [
+                (antibody_obj["name"], antibody_inputs(heavy_chain_obj, light_chain_obj), registered_antibody_obj)
+                for registered_antibody_obj, (antibody_obj, heavy_chain_obj, light_chain_obj) in zip(
+                    bulk_registered_antibody_response_obj, unregistered_antibodies
+                )
+            ],
         )
-        return
-    bulk_registred_antibody_response_obj = task_response[1]["customEntities"]
-
-    for antibody_obj, heavy_chain_obj, light_chain_obj in zip(
-        bulk_registred_antibody_response_obj,
-        bulk_registered_heavy_chain_response_obj,
-        bulk_registered_light_chain_response_obj,
-    ):
-
-        print(
-            "Registered new Antibody {} with Heavy Chain {} and Light Chain {}".format(
-                antibody_obj["entityRegistryId"],
-                heavy_chain_obj["entityRegistryId"],
-                light_chain_obj["entityRegistryId"],
+        for registered_antibody_obj, (_, heavy_chain_obj, light_chain_obj) in zip(
+            bulk_registered_antibody_response_obj, unregistered_antibodies
+        ):
+            output_lines.append(
+                "Registered new Antibody {} with Heavy Chain {} and Light Chain {}".format(
+                    registered_antibody_obj["entityRegistryId"],
+                    heavy_chain_obj["entityRegistryId"],
+                    light_chain_obj["entityRegistryId"],
+                )
             )
-        )
+        return output_lines, len(registered_antibodies) + len(unregistered_antibodies)
+
+    antibody_count = 0
+    registered_count = 0
+
+    def print_batch_result(future):
+        nonlocal registered_count
+        output_lines, batch_registered_count = future.result()
+        for line in output_lines:
+            print(line)
+        registered_count += batch_registered_count
+
+    # Batches are read from the file as they're needed, so that at most `concurrency` batches are
+    # in memory no matter how large the file is. Results are printed in file order.
+    with ThreadPoolExecutor(max_workers=concurrency) as batch_executor, ThreadPoolExecutor(
+        max_workers=concurrency
+    ) as chain_executor:
+        in_flight = deque()
+        for batch_number, antibody_obj_batch in enumerate(
+            iter_antibody_batches(json_file_to_import, batch_size), start=1
+        ):
+            antibody_count += len(antibody_obj_batch)
+            if len(in_flight) >= concurrency:
+                print_batch_result(in_flight.popleft())
+            in_flight.append(
+                batch_executor.submit(register_antibodies, batch_number, antibody_obj_batch)
+            )
+        while in_flight:
+            print_batch_result(in_flight.popleft())
 
+    if registered_count < antibody_count:
+        print("Registered {} of {} antibodies".format(registered_count, antibody_count))
 
 if __name__ == "__main__":
     main()
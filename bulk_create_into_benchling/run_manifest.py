@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+
+import click
+
+
+class RunManifest:
+    """
+    Record of the entities registered for each antibody in an import, so that rerunning a
+    partially failed import only registers what's missing.
+
+    Each antibody is identified by its name. For each phase ("Heavy Chain", "Light Chain" or
+    "Antibody") the manifest records the registered entity and the inputs it was registered with;
+    an entity is only reused if the antibody's inputs for that phase haven't changed.
+
+    If a `path` is given, the manifest is kept there as JSON Lines: the first line holds the
+    registry, folder and schemas of the import, and each following line records one registered
+    entity. Lines are only appended, and a crash while writing one just means that entity is
+    registered again on the next run. Without a `path`, the manifest only lasts for the current
+    run.
+
+    The manifest is safe to share between threads.
+    """
+
+    def __init__(self, header, path=None):
+        self.path = path
+        # (antibody name, phase) -> entry
+        self._entries = {}
+        self._lock = threading.Lock()
+        if path is None:
+            return
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                lines = [line for line in manifest_file if line.endswith("\n")]
+            if lines:
+                existing_header = json.loads(lines[0])
+                if existing_header != header:
+                    raise click.ClickException(
+                        "{} is the manifest of an import into a different registry, folder or "
+                        "schema: {}".format(path, existing_header)
+                    )
+                for line in lines[1:]:
+                    entry = json.loads(line)
+                    self._entries[(entry["antibody"], entry["phase"])] = entry
+                return
+        with open(path, "w") as manifest_file:
+            self._write_lines(manifest_file, [header])
+
+    def get(self, antibody_name, phase, inputs):
+        """
+        :returns: the entry recorded for the antibody's `phase`, or None if none was recorded
+            with the same `inputs`
+        """
+        with self._lock:
+            entry = self._entries.get((antibody_name, phase))
+        if entry is None or entry["inputs"] != inputs:
+            return None
+        return entry
+
+    def record(self, phase, registered):
+        """
+        Record newly registered entities.
+
+        :param registered: (antibody name, inputs, entity resource) for each registered entity
+        """
+        entries = [
+            {
+                "antibody": antibody_name,
+                "phase": phase,
+                "inputs": inputs,
+                "id": entity_json["id"],
+                "entityRegistryId": entity_json["entityRegistryId"],
+            }
+            for antibody_name, inputs, entity_json in registered
+        ]
+        with self._lock:
+            for entry in entries:
+                self._entries[(entry["antibody"], phase)] = entry
+            if self.path is not None:
+                with open(self.path, "a") as manifest_file:
+                    self._write_lines(manifest_file, entries)
+
+    @staticmethod
+    def _write_lines(manifest_file, entries):
+        manifest_file.writelines(json.dumps(entry) + "\n" for entry in entries)
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
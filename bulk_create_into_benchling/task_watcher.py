@@ -0,0 +1,140 @@
+# Waits for Benchling's long-running tasks, such as bulk creates, to finish.
+#
+# Tasks are polled quickly at first, since small ones finish in well under a second, and then less
+# and less often, so that long-running tasks don't use up the API rate limit.
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+from api_client import api_get
+
+INITIAL_POLL_SECONDS = 0.25
+MAX_POLL_SECONDS = 10.0
+POLL_BACKOFF_FACTOR = 2.0
+DEFAULT_TIMEOUT_SECONDS = 3600.0
+
+
+def next_poll_seconds(poll_seconds):
+    return min(MAX_POLL_SECONDS, poll_seconds * POLL_BACKOFF_FACTOR)
+
+
+def task_result(task_response):
+    """
+    :returns: ("SUCCEEDED", response) or ("FAILED", message, errors), or None if still running
+    """
+    status = task_response["status"]
+    if status == "FAILED":
+        return "FAILED", task_response["message"], task_response["errors"]
+    elif status == "SUCCEEDED":
+        return "SUCCEEDED", task_response["response"]
+    return None
+
+
+def timed_out_result(task_id, timeout_seconds):
+    return (
+        "FAILED",
+        "Task {} did not finish within {} seconds. It may still finish later.".format(
+            task_id, timeout_seconds
+        ),
+        [],
+    )
+
+
+def wait_on_task_response(domain, api_key, task_resource, timeout_seconds=DEFAULT_TIMEOUT_SECONDS):
+    """Poll a single task until it finishes or `timeout_seconds` have passed."""
+    task_id = task_resource["taskId"]
+    deadline = time.monotonic() + timeout_seconds
+    poll_seconds = INITIAL_POLL_SECONDS
+    while True:
+        result = task_result(api_get(domain, api_key, "tasks/{}".format(task_id)))
+        if result is not None:
+            return result
+        if time.monotonic() >= deadline:
+            return timed_out_result(task_id, timeout_seconds)
+        time.sleep(min(poll_seconds, max(0, deadline - time.monotonic())))
+        poll_seconds = next_poll_seconds(poll_seconds)
+
+
+class TaskWatcher:
+    """
+    Waits on many tasks at once from a single polling thread.
+
+    Each watched task has its own backoff, and is polled when it's due. watch() returns a Future
+    that resolves to the same tuples as wait_on_task_response.
+    """
+
+    def __init__(self, domain, api_key, timeout_seconds=DEFAULT_TIMEOUT_SECONDS):
+        self._domain = domain
+        self._api_key = api_key
+        self._timeout_seconds = timeout_seconds
+        # Heap of (poll_at, sequence number, task_id, poll_seconds, deadline, future)
+        self._scheduled = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def watch(self, task_resource):
+        future = Future()
+        now = time.monotonic()
+        with self._condition:
+            self._schedule(
+                now + INITIAL_POLL_SECONDS,
+                task_resource["taskId"],
+                INITIAL_POLL_SECONDS,
+                now + self._timeout_seconds,
+                future,
+            )
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def wait(self, task_resource):
+        return self.watch(task_resource).result()
+
+    def _schedule(self, poll_at, task_id, poll_seconds, deadline, future):
+        heapq.heappush(
+            self._scheduled,
+            (poll_at, next(self._sequence), task_id, poll_seconds, deadline, future),
+        )
+
+    def _next_due_tasks(self):
+        with self._condition:
+            while True:
+                if not self._scheduled:
+                    self._condition.wait()
+                    continue
+                wait_seconds = self._scheduled[0][0] - time.monotonic()
+                if wait_seconds > 0:
+                    self._condition.wait(wait_seconds)
+                    continue
+                now = time.monotonic()
+                due = []
+                while self._scheduled and self._scheduled[0][0] <= now:
+                    due.append(heapq.heappop(self._scheduled)[2:])
+                return due
+
+    def _run(self):
+        while True:
+            for task_id, poll_seconds, deadline, future in self._next_due_tasks():
+                try:
+                    result = task_result(
+                        api_get(self._domain, self._api_key, "tasks/{}".format(task_id))
+                    )
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                now = time.monotonic()
+                if result is not None:
+                    future.set_result(result)
+                elif now >= deadline:
+                    future.set_result(timed_out_result(task_id, self._timeout_seconds))
+                else:
+                    poll_seconds = next_poll_seconds(poll_seconds)
+                    with self._condition:
+                        self._schedule(
+                            min(now + poll_seconds, deadline), task_id, poll_seconds, deadline, future
+                        )
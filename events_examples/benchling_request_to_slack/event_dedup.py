@@ -0,0 +1,106 @@
+# event_dedup.py
+#
+# Remembers which Benchling events already have a Slack message, so that events delivered more
+# than once are only posted once.
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryEventStore:
+    """
+    Keys seen by this Lambda container, each forgotten `ttl_seconds` after it was added.
+
+    Only the `max_size` most recent keys are kept, so memory stays bounded during bursts.
+    """
+
+    def __init__(self, ttl_seconds, max_size=10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        # Key -> expiry time, oldest first
+        self._expires_at = OrderedDict()
+        self._lock = threading.Lock()
+
+    def contains(self, key):
+        with self._lock:
+            expires_at = self._expires_at.get(key)
+            if expires_at is None:
+                return False
+            if expires_at <= time.time():
+                del self._expires_at[key]
+                return False
+            return True
+
+    def add(self, keys):
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            for key in keys:
+                self._expires_at.pop(key, None)
+                self._expires_at[key] = expires_at
+            while len(self._expires_at) > self.max_size:
+                self._expires_at.popitem(last=False)
+
+
+class SqliteEventStore:
+    """
+    Keys kept in a SQLite database, each forgotten `ttl_seconds` after it was added.
+
+    A file under /tmp lasts as long as the Lambda container. A store shared by every container,
+    such as a DynamoDB table with a TTL attribute, can be used the same way by implementing
+    contains and add.
+    """
+
+    def __init__(self, path, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS sent_events (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+            )
+
+    def contains(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM sent_events WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return row is not None
+
+    def add(self, keys):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM sent_events WHERE expires_at <= ?", (now,))
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO sent_events (key, expires_at) VALUES (?, ?)",
+                [(key, now + self.ttl_seconds) for key in keys],
+            )
+
+
+class EventDeduplicator:
+    """
+    Checks an in-memory cache first, and then the persistent `store` if there is one.
+    """
+
+    def __init__(self, cache, store=None):
+        self.cache = cache
+        self.store = store
+
+    def is_duplicate(self, key):
+        if key is None:
+            return False
+        if self.cache.contains(key):
+            return True
+        if self.store is not None and self.store.contains(key):
+            self.cache.add([key])
+            return True
+        return False
+
+    def mark_sent(self, keys):
+        keys = [key for key in keys if key is not None]
+        if not keys:
+            return
+        self.cache.add(keys)
+        if self.store is not None:
+            self.store.add(keys)
@@ -2,59 +2,141 @@
 
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import urllib3
 
+from event_dedup import EventDeduplicator, MemoryEventStore, SqliteEventStore
+from slack_templates import SlackTemplates
+
+# Number of Slack messages sent at once when handling a batch of SQS records
+MAX_CONCURRENT_POSTS = int(os.environ.get("SLACK_MAX_CONCURRENT_POSTS", "10"))
+
+# Created once per Lambda container, so warm invocations reuse its connections to Slack
+http = urllib3.PoolManager(
+    maxsize=MAX_CONCURRENT_POSTS,
+    timeout=urllib3.Timeout(connect=3.0, read=10.0),
+)
+
+# Message templates for each event type, compiled once per Lambda container
+slack_templates = SlackTemplates.load(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "slack_templates.json")
+)
+
+# How long to remember the IDs of events that were sent to Slack, to drop redelivered events
+DEDUP_TTL_SECONDS = float(os.environ.get("DEDUP_TTL_SECONDS", "3600"))
+# Set DEDUP_SQLITE_PATH to also remember sent events in a SQLite database, e.g. /tmp/sent_events.db
+deduplicator = EventDeduplicator(
+    MemoryEventStore(DEDUP_TTL_SECONDS),
+    SqliteEventStore(os.environ["DEDUP_SQLITE_PATH"], DEDUP_TTL_SECONDS)
+    if os.environ.get("DEDUP_SQLITE_PATH")
+    else None,
+)
+# Set COALESCE_REQUEST_UPDATES to "true" to send one message for all the update events of the same
+# type about the same request in a batch of SQS records
+COALESCE_REQUEST_UPDATES = os.environ.get("COALESCE_REQUEST_UPDATES", "false").lower() == "true"
+
 
 def lambda_handler(event, context):
-    http = urllib3.PoolManager()
-    assignee_handles = []
-    for assignee in event["detail"]["request"]["assignees"]:
-        assignee_handles.append("@" + str(assignee["user"]["handle"]))
+    # Events can arrive directly from EventBridge, or in batches through an SQS queue
+    if "Records" in event:
+        return handle_sqs_records(event["Records"])
+
+    event_id = event.get("id")
+    if deduplicator.is_duplicate(event_id):
+        return {"statusCode": 200, "statusData": "Event {} was already sent".format(event_id)}
+    resp = post_to_slack(slack_message(event))
+    if 200 <= resp.status < 300:
+        deduplicator.mark_sent([event_id])
+    return {"statusCode": resp.status, "statusData": resp.data}
+
+
+def handle_sqs_records(records):
+    """
+    Send a Slack message for each SQS record, each holding an EventBridge event, in parallel.
+
+    Events that were already sent are dropped, and if COALESCE_REQUEST_UPDATES is set, only the
+    latest update event of each type about each request is sent. Returns the records that failed, so that only they
+    are retried. The SQS trigger must have ReportBatchItemFailures enabled.
+    """
+    batch_item_failures = []
+    # Each message to send: the IDs of the records it covers, their event IDs, and the event
+    messages = []
+    messages_by_coalesce_key = {}
+    event_ids_in_batch = set()
+    for record in records:
+        try:
+            event = json.loads(record["body"])
+        except ValueError as e:
+            print("Could not parse message {}: {!r}".format(record["messageId"], e))
+            batch_item_failures.append({"itemIdentifier": record["messageId"]})
+            continue
+        event_id = event.get("id")
+        if event_id in event_ids_in_batch or deduplicator.is_duplicate(event_id):
+            print("Skipping message {}: duplicate of event {}".format(record["messageId"], event_id))
+            continue
+        event_ids_in_batch.add(event_id)
 
-    # Create data payload for Slack POST request
+        key = coalesce_key(event) if COALESCE_REQUEST_UPDATES else None
+        message = messages_by_coalesce_key.get(key) if key is not None else None
+        if message is None:
+            message = {"messageIds": [], "eventIds": [], "event": event}
+            messages.append(message)
+            if key is not None:
+                messages_by_coalesce_key[key] = message
+        elif event.get("time", "") >= message["event"].get("time", ""):
+            message["event"] = event
+        message["messageIds"].append(record["messageId"])
+        message["eventIds"].append(event_id)
+
+    if not messages:
+        return {"batchItemFailures": batch_item_failures}
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_POSTS, len(messages))) as executor:
+        futures = [(message, executor.submit(send_event, message["event"])) for message in messages]
+    for message, future in futures:
+        try:
+            resp = future.result()
+        except Exception as e:
+            print("Could not send messages {} to Slack: {!r}".format(message["messageIds"], e))
+        else:
+            if 200 <= resp.status < 300:
+                deduplicator.mark_sent(message["eventIds"])
+                continue
+            print("Slack returned status {} for messages {}: {}".format(resp.status, message["messageIds"], resp.data))
+        batch_item_failures.extend({"itemIdentifier": message_id} for message_id in message["messageIds"])
+    return {"batchItemFailures": batch_item_failures}
+
+
+def coalesce_key(event):
+    """
+    Return what identifies the events that can be sent as one message: update events of the same
+    type about the same request. Other events, such as a request being created, are always sent.
+    """
+    event_type = event.get("detail-type") or event.get("detail", {}).get("eventType") or ""
+    request_id = event.get("detail", {}).get("request", {}).get("id")
+    if not event_type.startswith("v2.request.updated.") or request_id is None:
+        return None
+    return request_id, event_type
+
+
+def send_event(event):
+    return post_to_slack(slack_message(event))
+
+
+def slack_message(event):
+    # Create the JSON payload for Slack POST request from the event type's template
     # see https://api.slack.com/block-kit for more formatting options for the message
-    data = {
-        "blocks": [
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": " New Benchling Request Here!\n"
-                    + "<"
-                    + event["detail"]["request"]["webURL"]
-                    + "|Go To Benchling Request >",
-                },
-            },
-            {
-                "type": "section",
-                "fields": [
-                    {
-                        "type": "mrkdwn",
-                        "text": " *Requestor*:\n"
-                        + "@"
-                        + str(event["detail"]["request"]["creator"]["handle"]),
-                    },
-                    {"type": "mrkdwn", "text": " *Assignee(s)*:\n" + ", ".join(assignee_handles)},
-                    {
-                        "type": "mrkdwn",
-                        "text": " *Comments*:\n"
-                        + str(event["detail"]["request"]["fields"]["request_comments"]["value"]),
-                    },
-                ],
-            },
-            {"type": "divider"},
-        ]
-    }
+    return slack_templates.render(event)
+
 
+def post_to_slack(body):
     # Send POST request to webhook URL generated in Slack App admin settings
-    resp = http.request(
+    return http.request(
         "POST",
         os.environ["SLACK_WEBHOOK_URL"],
-        body=json.dumps(data),
+        body=body,
         headers={
             "Content-Type": "application/json",
             "Authorization": "Bearer {}".format(os.environ["SLACK_TOKEN"]),
         },
     )
-
-    return {"statusCode": resp.status, "statusData": resp.data}
@@ -0,0 +1,148 @@
+# slack_templates.py
+#
+# Builds Slack Block Kit messages from the templates in slack_templates.json. The templates are
+# compiled once, when the Lambda container starts, so each event only costs the lookups of the
+# fields its template uses.
+#
+# The file has shared "fields" and a "templates" object with a template for each Benchling event
+# type, and a "default" template for other event types. Each template has "blocks", in which text
+# like "{requestor}" is replaced by the value of a field, and can add or override "fields".
+#
+# A field has a "path" of keys into the event, separated by dots, where "*" stands for every item
+# of a list, e.g. "detail.request.assignees.*.user.handle". The value is formatted with "format"
+# (default "{}"), list items are joined with "join" (default ", "), and "default" (default "") is
+# used when the event doesn't have the field.
+
+import json
+import string
+from json.encoder import encode_basestring_ascii
+
+
+# Marks where a field's value goes in the JSON text of a compiled template. json.dumps escapes it
+# as \u0000, which templates can't contain.
+FIELD_MARKER = "\0"
+ESCAPED_FIELD_MARKER = json.dumps(FIELD_MARKER)[1:-1]
+
+
+class SlackTemplates:
+    def __init__(self, templates_json):
+        shared_fields = templates_json.get("fields", {})
+        self._templates = {
+            event_type: compile_template(
+                event_type, dict(shared_fields, **template.get("fields", {})), template["blocks"]
+            )
+            for event_type, template in templates_json["templates"].items()
+        }
+        self._default_template = self._templates.get("default")
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as templates_file:
+            return cls(json.load(templates_file))
+
+    def render(self, event):
+        """
+        Build the Slack message for an EventBridge event from Benchling.
+
+        :returns: the JSON text of the message, ready to be posted to Slack
+        """
+        event_type = event.get("detail-type") or event.get("detail", {}).get("eventType")
+        template = self._templates.get(event_type, self._default_template)
+        if template is None:
+            raise KeyError("No Slack template for event type {}".format(event_type))
+        return template(event)
+
+
+def compile_template(event_type, fields, blocks):
+    """
+    Serialize the message to JSON once, and split the text where fields go, so that each event
+    only costs looking up and escaping the fields its template uses.
+    """
+    slot_field_names = []
+    message_json = json.dumps({"blocks": mark_fields(blocks, slot_field_names)})
+    unknown_field_names = set(slot_field_names) - set(fields)
+    if unknown_field_names:
+        raise ValueError(
+            "Slack template {} uses unknown fields: {}".format(event_type, sorted(unknown_field_names))
+        )
+    # The text before, between and after the fields
+    texts = tuple(message_json.split(ESCAPED_FIELD_MARKER))
+    slots = tuple(zip(slot_field_names, texts[1:]))
+    field_renderers = tuple((name, compile_field(fields[name])) for name in set(slot_field_names))
+    first_text = texts[0]
+
+    def render(event):
+        values = {name: encode_basestring_ascii(render_field(event))[1:-1] for name, render_field in field_renderers}
+        rendered = [first_text]
+        for name, text in slots:
+            rendered.append(values[name])
+            rendered.append(text)
+        return "".join(rendered)
+
+    return render
+
+
+def mark_fields(value, slot_field_names):
+    """
+    Copy part of a template, replacing each "{field}" in its text by a marker, and adding the
+    names of the fields to `slot_field_names` in the order they appear.
+    """
+    if isinstance(value, dict):
+        return {key: mark_fields(item, slot_field_names) for key, item in value.items()}
+    if isinstance(value, list):
+        return [mark_fields(item, slot_field_names) for item in value]
+    if not isinstance(value, str):
+        return value
+    if FIELD_MARKER in value or ESCAPED_FIELD_MARKER in value:
+        raise ValueError("Slack templates can't contain {!r}".format(value))
+    marked = []
+    for literal_text, field_name, format_spec, conversion in string.Formatter().parse(value):
+        marked.append(literal_text)
+        if field_name is None:
+            continue
+        if format_spec or conversion:
+            raise ValueError('Use "format" in the field instead of "{}"'.format(value))
+        marked.append(FIELD_MARKER)
+        slot_field_names.append(field_name)
+    return "".join(marked)
+
+
+def compile_field(field):
+    keys = tuple(field["path"].split("."))
+    format_value = field.get("format", "{}").format
+    default = str(field.get("default", ""))
+    if "*" not in keys:
+        get_value = compile_accessor(keys)
+
+        def render_field(event):
+            value = get_value(event)
+            return default if value is None else format_value(value)
+
+        return render_field
+
+    star_index = keys.index("*")
+    get_items = compile_accessor(keys[:star_index])
+    get_item_value = compile_accessor(keys[star_index + 1:])
+    join = field.get("join", ", ").join
+
+    def render_list_field(event):
+        items = get_items(event)
+        if not isinstance(items, list):
+            return default
+        values = [format_value(value) for value in map(get_item_value, items) if value is not None]
+        return join(values) if values else default
+
+    return render_list_field
+
+
+def compile_accessor(keys):
+    """Return a function that looks up `keys` in nested dicts, or returns None if one is missing."""
+
+    def get_value(value):
+        for key in keys:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    return get_value
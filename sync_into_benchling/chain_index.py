@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+
+
+def normalize_aa_sequence(aa_sequence):
+    return "".join(aa_sequence.split()).upper()
+
+
+class ChainIndex:
+    """
+    Registered Chains of one schema, indexed by normalized amino acid sequence.
+
+    Sequences are looked up in Benchling at most once per run. If a `cache_path` is given,
+    registered Chains are also saved there, so later runs don't need to look them up again until
+    `ttl_seconds` after they were found or registered, in case a Chain has been archived since.
+    Sequences with no registered Chain are only remembered for the current run, since a Chain
+    may be registered for them later.
+
+    The index is safe to share between threads.
+    """
+
+    def __init__(self, chain_schema_id, cache_path=None, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.chain_schema_id = chain_schema_id
+        self.cache_path = cache_path
+        # Normalized AA sequence -> registered Chain, or None if there is no registered Chain
+        self._chains = {}
+        # Normalized AA sequence -> when its Chain was found or registered
+        self._fetched_at = {}
+        self._lock = threading.Lock()
+        # Normalized AA sequence -> lock held while finding or creating its Chain
+        self._sequence_locks = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path) as cache_file:
+                cached_chains = json.load(cache_file).get(chain_schema_id, {})
+            now = time.time()
+            for aa_sequence, entry in cached_chains.items():
+                # Entries without a fetchedAt were written before the cache expired, so they are
+                # looked up again too
+                if "fetchedAt" in entry and now - entry["fetchedAt"] < ttl_seconds:
+                    self._chains[aa_sequence] = entry["chain"]
+                    self._fetched_at[aa_sequence] = entry["fetchedAt"]
+
+    def resolve(self, aa_sequences, lookup, concurrency=1):
+        """
+        Look up every sequence in `aa_sequences` that isn't indexed yet, `concurrency` at a time.
+
+        :param lookup: called with a normalized AA sequence, returns its registered Chain or None
+        """
+        missing_aa_sequences = list(
+            {normalize_aa_sequence(aa_sequence) for aa_sequence in aa_sequences} - set(self._chains)
+        )
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for aa_sequence, chain_json in zip(
+                missing_aa_sequences, executor.map(lookup, missing_aa_sequences)
+            ):
+                with self._lock:
+                    self._set(aa_sequence, chain_json)
+
+    def get(self, aa_sequence):
+        """Return the indexed registered Chain with `aa_sequence`, or None."""
+        with self._lock:
+            return self._chains.get(normalize_aa_sequence(aa_sequence))
+
+    def add(self, aa_sequence, chain_json):
+        with self._lock:
+            self._set(normalize_aa_sequence(aa_sequence), chain_json)
+
+    def _set(self, key, chain_json):
+        self._chains[key] = chain_json
+        self._fetched_at[key] = time.time()
+
+    def find_or_create(self, aa_sequence, lookup, create):
+        """
+        Return the registered Chain with `aa_sequence`, calling `lookup` if it isn't indexed yet,
+        and `create` if no Chain is registered with it.
+
+        Only one thread at a time finds or creates the Chain for a given sequence, so concurrent
+        callers never try to register the same sequence twice. The others wait and then get the
+        Chain it found or created.
+
+        :param lookup: called with a normalized AA sequence, returns its registered Chain or None
+        :param create: called with a normalized AA sequence, returns the newly registered Chain
+        """
+        key = normalize_aa_sequence(aa_sequence)
+        with self._lock:
+            sequence_lock = self._sequence_locks.setdefault(key, threading.Lock())
+        with sequence_lock:
+            with self._lock:
+                is_indexed = key in self._chains
+                chain_json = self._chains.get(key)
+            if is_indexed and chain_json is not None:
+                return chain_json
+            if not is_indexed:
+                chain_json = lookup(key)
+            if chain_json is None:
+                chain_json = create(key)
+            with self._lock:
+                self._set(key, chain_json)
+            return chain_json
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        cache = {}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path) as cache_file:
+                cache = json.load(cache_file)
+        with self._lock:
+            cache[self.chain_schema_id] = {
+                aa_sequence: {"chain": chain_json, "fetchedAt": self._fetched_at[aa_sequence]}
+                for aa_sequence, chain_json in self._chains.items()
+                if chain_json is not None
+            }
+        temp_path = "{}.tmp".format(self.cache_path)
+        with open(temp_path, "w") as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(temp_path, self.cache_path)
@@ -1,39 +1,13 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 import click
-import requests
 
-
-class BadRequestException(Exception):
-    def __init__(self, message, rv):
-        super(BadRequestException, self).__init__(message)
-        self.rv = rv
-
-
-def api_get(domain, api_key, path):
-    url = "https://{}/api/v2/{}".format(domain, path)
-    rv = requests.get(url, auth=(api_key, ""))
-    if rv.status_code >= 400:
-        raise BadRequestException(
-            "Server returned status {}. Response:\n{}".format(
-                rv.status_code, json.dumps(rv.json())
-            ),
-            rv,
-        )
-    return rv.json()
-
-
-def api_post(domain, api_key, path, body):
-    url = "https://{}/api/v2/{}".format(domain, path)
-    rv = requests.post(url, json=body, auth=(api_key, ""))
-    if rv.status_code >= 400:
-        raise BadRequestException(
-            "Server returned status {}. Response:\n{}".format(
-                rv.status_code, json.dumps(rv.json())
-            ),
-            rv,
-        )
-    return rv.json()
+import api_client
+from antibody_reader import iter_antibody_batches
+from api_client import BadRequestException, api_get, api_post
+from chain_index import DEFAULT_TTL_SECONDS, ChainIndex, normalize_aa_sequence
+from task_watcher import wait_on_task_response
 
 
 def get_existing_registered_chain_with_aa_sequence(
@@ -48,7 +22,8 @@ def get_existing_registered_chain_with_aa_sequence(
         domain,
         api_key,
         # https://docs.benchling.com/v2/reference#list-amino-acid-sequences
-        "aa-sequences?schemaId={}&aminoAcids={}".format(chain_schema_id, aa_sequence),
+        "aa-sequences",
+        params={"schemaId": chain_schema_id, "aminoAcids": aa_sequence},
     )
     matching_registered_chains = [
         chain_json
@@ -70,7 +45,7 @@ def get_existing_registered_chain_with_aa_sequence(
 
 
 def find_or_create_chain_in_registry_with_aa_sequence(
-    domain, api_key, folder_id, registry_id, chain_schema_id, chain_name, aa_sequence
+    domain, api_key, folder_id, registry_id, chain_schema_id, chain_name, aa_sequence, chain_index
 ):
     """
     Find or create a Chain entity with the given amino acid sequence.
@@ -80,28 +55,31 @@ def find_or_create_chain_in_registry_with_aa_sequence(
     # The Chain schema has a unique constraint on the AA sequence,
     # so if there's already a registered Chain with the same sequence,
     # we should use the existing Chain instead of creating a new one.
-    existing_registered_chain_json = get_existing_registered_chain_with_aa_sequence(
-        domain, api_key, chain_schema_id, aa_sequence
-    )
-    if existing_registered_chain_json is not None:
-        return existing_registered_chain_json
+    # The index also makes sure no two threads create a Chain with the same sequence.
+    def create_chain(aa_sequence):
+        # No Chain was registered with the same AA sequence, so create a new one in the registry.
+        return api_post(
+            domain,
+            api_key,
+            # https://docs.benchling.com/v2/reference#create-protein
+            "aa-sequences",
+            {
+                "aminoAcids": aa_sequence,
+                "folderId": folder_id,
+                "name": chain_name,
+                "schemaId": chain_schema_id,
+                "registryId": registry_id,
+                "namingStrategy": "NEW_IDS",
+            },
+        )
 
-    # No Chain was registered with the same AA sequence, so create a new one in the registry.
-    chain_json = api_post(
-        domain,
-        api_key,
-        # https://docs.benchling.com/v2/reference#create-protein
-        "aa-sequences",
-        {
-            "aminoAcids": aa_sequence,
-            "folderId": folder_id,
-            "name": chain_name,
-            "schemaId": chain_schema_id,
-            "registryId": registry_id,
-            "namingStrategy": "NEW_IDS",
-        },
+    return chain_index.find_or_create(
+        aa_sequence,
+        lambda aa_sequence: get_existing_registered_chain_with_aa_sequence(
+            domain, api_key, chain_schema_id, aa_sequence
+        ),
+        create_chain,
     )
-    return chain_json
 
 
 @click.command()
@@ -121,6 +99,54 @@ def find_or_create_chain_in_registry_with_aa_sequence(
     help="ID of the Chain schema (Must be an AA-Sequence)",
     required=True,
 )
+@click.option(
+    "--max-requests-per-second",
+    help="Client-side limit on API requests per second; set this to your tenant's API quota",
+    type=click.FloatRange(min=0.01),
+    default=api_client.DEFAULT_MAX_REQUESTS_PER_SECOND,
+    show_default=True,
+)
+@click.option(
+    "--lookup-concurrency",
+    help="Number of Chain sequences to look up in parallel before importing",
+    type=click.IntRange(min=1),
+    default=8,
+    show_default=True,
+)
+@click.option(
+    "--chain-cache-file",
+    help="JSON file to remember registered Chains in, so later imports don't look them up again",
+    type=click.Path(dir_okay=False),
+)
+@click.option(
+    "--chain-cache-ttl",
+    help="Seconds a cached Chain is used before it's looked up again, in case it was archived",
+    type=click.IntRange(min=0),
+    default=DEFAULT_TTL_SECONDS,
+    show_default=True,
+)
+@click.option(
+    "--concurrency",
+    help="Number of antibodies to import in parallel",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+)
+@click.option(
+    "--bulk",
+    help=(
+        "Register the Chains that don't exist yet, and then all the antibodies, "
+        "with bulk-create tasks instead of one request per entity"
+    ),
+    is_flag=True,
+)
+@click.option(
+    "--batch-size",
+    help="Number of antibodies to read from the file and import at a time",
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+)
 @click.argument("json_file_to_import", type=click.File("r"))
 def main(
     domain,
@@ -129,40 +155,126 @@ def main(
     registry_id,
     chain_schema_id,
     folder_id,
+    max_requests_per_second,
+    lookup_concurrency,
+    chain_cache_file,
+    chain_cache_ttl,
+    concurrency,
+    bulk,
+    batch_size,
     json_file_to_import,
 ):
-    antibodies_json = json.loads(json_file_to_import.read())
+    api_client.configure(
+        max_requests_per_second=max_requests_per_second,
+        pool_size=max(lookup_concurrency, concurrency),
+    )
+    chain_index = ChainIndex(chain_schema_id, chain_cache_file, chain_cache_ttl)
+    try:
+        # The file is read one batch at a time, so that memory use doesn't grow with its size
+        for antibodies_json in iter_antibody_batches(json_file_to_import, batch_size):
+            # Look up every distinct Chain sequence in the batch up front, in parallel, rather
+            # than one by one for each antibody
+            chain_index.resolve(
+                [
+                    antibody_json[chain_field]
+                    for antibody_json in antibodies_json
+                    for chain_field in ("Heavy Chain", "Light Chain")
+                ],
+                lambda aa_sequence: get_existing_registered_chain_with_aa_sequence(
+                    domain, api_key, chain_schema_id, aa_sequence
+                ),
+                concurrency=lookup_concurrency,
+            )
 
-    for antibody_json in antibodies_json["antibodies"]:
-        # Create Heavy Chain in registry
-        heavy_chain_json = find_or_create_chain_in_registry_with_aa_sequence(
-            domain,
-            api_key,
-            folder_id,
-            registry_id,
-            chain_schema_id,
-            "Heavy Chain for {}".format(antibody_json["name"]),
-            antibody_json["Heavy Chain"],
-        )
+            if bulk:
+                bulk_import_antibodies(
+                    domain,
+                    api_key,
+                    antibody_schema_id,
+                    registry_id,
+                    chain_schema_id,
+                    folder_id,
+                    antibodies_json,
+                    chain_index,
+                )
+            else:
+                import_antibodies(
+                    domain,
+                    api_key,
+                    antibody_schema_id,
+                    registry_id,
+                    chain_schema_id,
+                    folder_id,
+                    antibodies_json,
+                    chain_index,
+                    concurrency,
+                )
+    finally:
+        chain_index.save()
 
-        # Create Light Chain in registry
-        light_chain_json = find_or_create_chain_in_registry_with_aa_sequence(
+def bulk_import_antibodies(
+    domain,
+    api_key,
+    antibody_schema_id,
+    registry_id,
+    chain_schema_id,
+    folder_id,
+    antibodies_json,
+    chain_index,
+):
+    """
+    Register the Chains that aren't in `chain_index` yet and then all the antibodies, each with
+    one bulk-create task. `chain_index` must already have resolved every Chain sequence.
+    """
+    # Each missing sequence is registered once, named after the first antibody that uses it
+    missing_chain_names = {}
+    for antibody_json in antibodies_json:
+        for chain_field in ("Heavy Chain", "Light Chain"):
+            aa_sequence = normalize_aa_sequence(antibody_json[chain_field])
+            if chain_index.get(aa_sequence) is None and aa_sequence not in missing_chain_names:
+                missing_chain_names[aa_sequence] = "{} for {}".format(chain_field, antibody_json["name"])
+
+    if missing_chain_names:
+        task_resource = api_post(
             domain,
             api_key,
-            folder_id,
-            registry_id,
-            chain_schema_id,
-            "Light Chain for {}".format(antibody_json["name"]),
-            antibody_json["Light Chain"],
+            # https://docs.benchling.com/reference#bulk-create-aa-sequences
+            "aa-sequences:bulk-create",
+            {
+                "aaSequences": [
+                    {
+                        "aminoAcids": aa_sequence,
+                        "folderId": folder_id,
+                        "name": chain_name,
+                        "schemaId": chain_schema_id,
+                        "registryId": registry_id,
+                        "namingStrategy": "NEW_IDS",
+                    }
+                    for aa_sequence, chain_name in missing_chain_names.items()
+                ]
+            },
         )
+        task_response = wait_on_task_response(domain, api_key, task_resource)
+        if task_response[0] == "FAILED":
+            print(
+                "Could not register at least one chain. Error response from server:\n{}\n{}".format(
+                    task_response[1],
+                    task_response[2],
+                )
+            )
+            return
+        # Bulk-created entities are returned in the same order as they were submitted
+        for aa_sequence, chain_json in zip(missing_chain_names, task_response[1]["aaSequences"]):
+            chain_index.add(aa_sequence, chain_json)
+    print("Registered {} new chains".format(len(missing_chain_names)))
 
-        try:
-            # Create antibody in registry
-            registered_antibody_response_json = api_post(
-                domain,
-                api_key,
-                # https://docs.benchling.com/reference#create-custom-entity
-                "custom-entities",
+    task_resource = api_post(
+        domain,
+        api_key,
+        # https://docs.benchling.com/reference#bulk-create-custom-entities
+        "custom-entities:bulk-create",
+        {
+            "customEntities": [
                 {
                     "name": antibody_json["name"],
                     "schemaId": antibody_schema_id,
@@ -170,30 +282,141 @@ def main(
                     "registryId": registry_id,
                     "namingStrategy": "NEW_IDS",
                     "fields": {
-                        "Heavy Chain": {"value": heavy_chain_json["entityRegistryId"]},
-                        "Light Chain": {"value": light_chain_json["entityRegistryId"]},
+                        "Heavy Chain": {
+                            "value": chain_index.get(antibody_json["Heavy Chain"])["entityRegistryId"]
+                        },
+                        "Light Chain": {
+                            "value": chain_index.get(antibody_json["Light Chain"])["entityRegistryId"]
+                        },
                     },
-                },
+                }
+                for antibody_json in antibodies_json
+            ]
+        },
+    )
+    task_response = wait_on_task_response(domain, api_key, task_resource)
+    if task_response[0] == "FAILED":
+        print(
+            "Could not register at least one antibody. Error response from server:\n{}\n{}".format(
+                task_response[1],
+                task_response[2],
             )
-        except BadRequestException as e:
-            if e.rv.status_code == 400:
-                print(
-                    "Could not register {}. Error response from server:\n{}".format(
-                        antibody_json["name"], json.dumps(e.rv.json())
-                    )
-                )
-                continue
-            else:
-                raise e
+        )
+        return
 
+    for antibody_json, registered_antibody_json in zip(
+        antibodies_json, task_response[1]["customEntities"]
+    ):
         print(
             "Registered new Antibody {} with Heavy Chain {} and Light Chain {}".format(
-                registered_antibody_response_json["entityRegistryId"],
-                heavy_chain_json["entityRegistryId"],
-                light_chain_json["entityRegistryId"],
+                registered_antibody_json["entityRegistryId"],
+                chain_index.get(antibody_json["Heavy Chain"])["entityRegistryId"],
+                chain_index.get(antibody_json["Light Chain"])["entityRegistryId"],
             )
         )
 
 
+def import_antibodies(
+    domain,
+    api_key,
+    antibody_schema_id,
+    registry_id,
+    chain_schema_id,
+    folder_id,
+    antibodies_json,
+    chain_index,
+    concurrency=1,
+):
+    def import_one(antibody_json):
+        import_antibody(
+            domain,
+            api_key,
+            antibody_schema_id,
+            registry_id,
+            chain_schema_id,
+            folder_id,
+            antibody_json,
+            chain_index,
+        )
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Consume the results so that any unexpected error is raised here
+        for _ in executor.map(import_one, antibodies_json):
+            pass
+
+
+def import_antibody(
+    domain,
+    api_key,
+    antibody_schema_id,
+    registry_id,
+    chain_schema_id,
+    folder_id,
+    antibody_json,
+    chain_index,
+):
+    # Create Heavy Chain in registry
+    heavy_chain_json = find_or_create_chain_in_registry_with_aa_sequence(
+        domain,
+        api_key,
+        folder_id,
+        registry_id,
+        chain_schema_id,
+        "Heavy Chain for {}".format(antibody_json["name"]),
+        antibody_json["Heavy Chain"],
+        chain_index,
+    )
+
+    # Create Light Chain in registry
+    light_chain_json = find_or_create_chain_in_registry_with_aa_sequence(
+        domain,
+        api_key,
+        folder_id,
+        registry_id,
+        chain_schema_id,
+        "Light Chain for {}".format(antibody_json["name"]),
+        antibody_json["Light Chain"],
+        chain_index,
+    )
+
+    try:
+        # Create antibody in registry
+        registered_antibody_response_json = api_post(
+            domain,
+            api_key,
+            # https://docs.benchling.com/reference#create-custom-entity
+            "custom-entities",
+            {
+                "name": antibody_json["name"],
+                "schemaId": antibody_schema_id,
+                "folderId": folder_id,
+                "registryId": registry_id,
+                "namingStrategy": "NEW_IDS",
+                "fields": {
+                    "Heavy Chain": {"value": heavy_chain_json["entityRegistryId"]},
+                    "Light Chain": {"value": light_chain_json["entityRegistryId"]},
+                },
+            },
+        )
+    except BadRequestException as e:
+        if e.rv.status_code == 400:
+            print(
+                "Could not register {}. Error response from server:\n{}".format(
+                    antibody_json["name"], json.dumps(e.rv.json())
+                )
+            )
+            return
+        else:
+            raise e
+
+    print(
+        "Registered new Antibody {} with Heavy Chain {} and Light Chain {}".format(
+            registered_antibody_response_json["entityRegistryId"],
+            heavy_chain_json["entityRegistryId"],
+            light_chain_json["entityRegistryId"],
+        )
+    )
+
+
 if __name__ == "__main__":
     main()
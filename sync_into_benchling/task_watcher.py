@@ -0,0 +1,54 @@
+# Waits for Benchling's long-running tasks, such as bulk creates, to finish.
+#
+# Tasks are polled quickly at first, since small ones finish in well under a second, and then less
+# and less often, so that long-running tasks don't use up the API rate limit.
+import time
+
+from api_client import api_get
+
+INITIAL_POLL_SECONDS = 0.25
+MAX_POLL_SECONDS = 10.0
+POLL_BACKOFF_FACTOR = 2.0
+DEFAULT_TIMEOUT_SECONDS = 3600.0
+
+
+def next_poll_seconds(poll_seconds):
+    return min(MAX_POLL_SECONDS, poll_seconds * POLL_BACKOFF_FACTOR)
+
+
+def task_result(task_response):
+    """
+    :returns: ("SUCCEEDED", response) or ("FAILED", message, errors), or None if still running
+    """
+    status = task_response["status"]
+    if status == "FAILED":
+        return "FAILED", task_response["message"], task_response["errors"]
+    elif status == "SUCCEEDED":
+        return "SUCCEEDED", task_response["response"]
+    return None
+
+
+def timed_out_result(task_id, timeout_seconds):
+    return (
+        "FAILED",
+        "Task {} did not finish within {} seconds. It may still finish later.".format(
+            task_id, timeout_seconds
+        ),
+        [],
+    )
+
+
+def wait_on_task_response(domain, api_key, task_resource, timeout_seconds=DEFAULT_TIMEOUT_SECONDS):
+    """Poll a single task until it finishes or `timeout_seconds` have passed."""
+    task_id = task_resource["taskId"]
+    deadline = time.monotonic() + timeout_seconds
+    poll_seconds = INITIAL_POLL_SECONDS
+    while True:
+        result = task_result(api_get(domain, api_key, "tasks/{}".format(task_id)))
+        if result is not None:
+            return result
+        if time.monotonic() >= deadline:
+            return timed_out_result(task_id, timeout_seconds)
+        time.sleep(min(poll_seconds, max(0, deadline - time.monotonic())))
+        poll_seconds = next_poll_seconds(poll_seconds)
+
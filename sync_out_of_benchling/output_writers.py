@@ -0,0 +1,203 @@
+import csv
+import gzip
+import io
+import json
+import sys
+
+import click
+
+OUTPUT_FORMATS = ["csv", "jsonl", "parquet", "arrow"]
+COMPRESSIONS = ["none", "gzip", "zstd"]
+# Rows per Parquet row group / Arrow record batch
+COLUMNAR_BATCH_SIZE = 50000
+
+
+def open_output_writer(output_format, compression, path, columns, resume_at=None):
+    """
+    Open a writer for rows whose values are in the same order as `columns`.
+
+    CSV and JSON Lines are written to standard output if no `path` is given. Parquet and Arrow IPC
+    need a `path`, and compress their column data internally: Parquet uses snappy unless another
+    compression is requested, and Arrow IPC only supports zstd.
+
+    If `resume_at` is given, the output is continued instead of replaced: the file is cut back to
+    `resume_at` bytes, as returned by the writer's tell, and rows are appended after it. Only
+    outputs for which can_resume_output is true can be continued.
+    """
+    validate_output_options(output_format, compression, path)
+    if resume_at is not None:
+        if not can_resume_output(output_format, compression, path):
+            raise ValueError("{} output can't be continued".format(output_format))
+        stream = open(path, "r+", newline="", encoding="utf-8")
+        stream.truncate(resume_at)
+        stream.seek(resume_at)
+        if output_format == "csv":
+            return CsvWriter(stream, columns, flush_pages=True, write_header=False)
+        return JsonLinesWriter(stream, columns, flush_pages=True)
+    if output_format in ("csv", "jsonl"):
+        stream = open_text_stream(path, compression)
+        if output_format == "csv":
+            return CsvWriter(stream, columns, flush_pages=compression == "none")
+        return JsonLinesWriter(stream, columns, flush_pages=compression == "none")
+    if output_format == "parquet":
+        return ParquetWriter(path, columns, compression)
+    return ArrowWriter(path, columns, compression)
+
+
+def validate_output_options(output_format, compression, path):
+    if output_format in ("parquet", "arrow") and path is None:
+        raise click.UsageError("--output is required for {} output".format(output_format))
+    if output_format == "arrow" and compression == "gzip":
+        raise click.UsageError("Arrow output can only be compressed with zstd")
+
+
+def can_resume_output(output_format, compression, path):
+    """
+    Whether an interrupted export can be continued in the same file. Compressed streams, Parquet
+    and Arrow files only become readable once they are closed, and what was printed to standard
+    output can't be recovered, so those exports are started over instead.
+    """
+    return path is not None and output_format in ("csv", "jsonl") and compression == "none"
+
+
+def open_text_stream(path, compression):
+    if compression == "none":
+        if path is None:
+            return sys.stdout
+        return open(path, "w", newline="", encoding="utf-8")
+
+    binary_stream = sys.stdout.buffer if path is None else open(path, "wb")
+    if compression == "gzip":
+        compressed_stream = gzip.GzipFile(fileobj=binary_stream, mode="wb")
+    else:
+        zstandard = import_optional("zstandard", "zstd compression")
+        compressed_stream = zstandard.ZstdCompressor().stream_writer(
+            binary_stream, closefd=path is not None
+        )
+    return io.TextIOWrapper(compressed_stream, encoding="utf-8", newline="")
+
+
+def import_optional(module_name, feature):
+    try:
+        return __import__(module_name)
+    except ImportError:
+        raise click.ClickException(
+            "{} requires the {} package. Install it with `pipenv install {}`.".format(
+                feature, module_name, module_name
+            )
+        )
+
+
+class TextWriter:
+    def __init__(self, stream, flush_pages):
+        self._stream = stream
+        self._flush_pages = flush_pages
+
+    def write_rows(self, rows):
+        self._write_rows(rows)
+        # Let consumers of uncompressed output see each page as soon as it's written
+        if self._flush_pages:
+            self._stream.flush()
+
+    def tell(self):
+        """
+        Return the position after the rows written so far, to pass to open_output_writer as
+        `resume_at`. Only meaningful for outputs that can be resumed, which are flushed each page.
+        """
+        return self._stream.tell()
+
+    def close(self):
+        if self._stream is sys.stdout:
+            self._stream.flush()
+        else:
+            self._stream.close()
+
+
+class CsvWriter(TextWriter):
+    def __init__(self, stream, columns, flush_pages, write_header=True):
+        super(CsvWriter, self).__init__(stream, flush_pages)
+        self._writer = csv.writer(stream)
+        if write_header:
+            self._writer.writerow(columns)
+
+    def _write_rows(self, rows):
+        self._writer.writerows(rows)
+
+
+class JsonLinesWriter(TextWriter):
+    def __init__(self, stream, columns, flush_pages):
+        super(JsonLinesWriter, self).__init__(stream, flush_pages)
+        self._columns = columns
+
+    def _write_rows(self, rows):
+        self._stream.writelines(
+            json.dumps(dict(zip(self._columns, row))) + "\n" for row in rows
+        )
+
+
+class ColumnarWriter:
+    """
+    Buffers rows and writes them in batches of COLUMNAR_BATCH_SIZE, transposed into columns so
+    that no per-row dict is built. Subclasses open `self._writer`, which must have write_table.
+    """
+
+    def __init__(self, columns, feature):
+        self._pyarrow = import_optional("pyarrow", feature)
+        self._schema = self._pyarrow.schema(
+            [(column, self._pyarrow.string()) for column in columns]
+        )
+        self._rows = []
+
+    def write_rows(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= COLUMNAR_BATCH_SIZE:
+            self._write_batch()
+
+    def _write_batch(self):
+        if not self._rows:
+            return
+        columns = list(zip(*self._rows))
+        self._writer.write_table(self._pyarrow.Table.from_arrays(
+            [self._pyarrow.array(column, type=self._pyarrow.string()) for column in columns],
+            schema=self._schema,
+        ))
+        self._rows = []
+
+    def close(self):
+        self._write_batch()
+        self._writer.close()
+
+
+class ParquetWriter(ColumnarWriter):
+    """Writes one Parquet row group per batch."""
+
+    def __init__(self, path, columns, compression):
+        super(ParquetWriter, self).__init__(columns, "Parquet output")
+        import pyarrow.parquet
+
+        self._writer = pyarrow.parquet.ParquetWriter(
+            path,
+            self._schema,
+            compression="snappy" if compression == "none" else compression,
+        )
+
+
+class ArrowWriter(ColumnarWriter):
+    """Writes an Arrow IPC file with one record batch per batch."""
+
+    def __init__(self, path, columns, compression):
+        super(ArrowWriter, self).__init__(columns, "Arrow output")
+        import pyarrow.ipc
+
+        self._sink = self._pyarrow.OSFile(path, "wb")
+        self._writer = pyarrow.ipc.new_file(
+            self._sink,
+            self._schema,
+            options=pyarrow.ipc.IpcWriteOptions(
+                compression=None if compression == "none" else compression
+            ),
+        )
+
+    def close(self):
+        super(ArrowWriter, self).close()
+        self._sink.close()
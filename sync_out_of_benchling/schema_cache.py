@@ -0,0 +1,58 @@
+import json
+import os
+import time
+
+from api_client import raise_for_status, request
+
+DEFAULT_TTL_SECONDS = 60 * 60
+
+
+def get_entity_schema(domain, api_key, registry_id, schema_id, cache_path=None, ttl_seconds=DEFAULT_TTL_SECONDS):
+    """
+    Get an entity schema, including its ordered field definitions.
+
+    If `cache_path` is given, schemas are cached in that JSON file. A cached schema younger than
+    `ttl_seconds` is used without calling the API. An older one is revalidated with its ETag, so
+    it is only downloaded again if it has changed.
+
+    :returns: an Entity Schema resource (https://docs.benchling.com/v2/reference#list-entity-schemas)
+    """
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+    key = "{}/{}/{}".format(domain, registry_id, schema_id)
+    cached = cache.get(key)
+    if cached is not None and time.time() - cached["fetchedAt"] < ttl_seconds:
+        return cached["schema"]
+
+    headers = {}
+    if cached is not None and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    rv = request(
+        "GET",
+        domain,
+        api_key,
+        # https://docs.benchling.com/v2/reference#list-entity-schemas
+        "registries/{registry_id}/entity-schemas".format(registry_id=registry_id),
+        headers=headers,
+    )
+    if rv.status_code == 304:
+        schema_json = cached["schema"]
+        etag = cached["etag"]
+    else:
+        raise_for_status(rv)
+        [schema_json] = [
+            schema_json
+            for schema_json in rv.json()["entitySchemas"]
+            if schema_json["id"] == schema_id
+        ]
+        etag = rv.headers.get("ETag")
+
+    if cache_path is not None:
+        cache[key] = {"schema": schema_json, "etag": etag, "fetchedAt": time.time()}
+        temp_path = "{}.tmp".format(cache_path)
+        with open(temp_path, "w") as cache_file:
+            json.dump(cache, cache_file, indent=2, sort_keys=True)
+        os.replace(temp_path, cache_path)
+    return schema_json
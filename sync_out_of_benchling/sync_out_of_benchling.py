@@ -1,23 +1,185 @@
-import csv
-import json
+import datetime
+import itertools
+import os
+import queue
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import click
-import requests
 
+import api_client
+from api_client import BadRequestException, api_get
+from output_writers import (
+    COMPRESSIONS,
+    OUTPUT_FORMATS,
+    can_resume_output,
+    open_output_writer,
+    validate_output_options,
+)
+from schema_cache import DEFAULT_TTL_SECONDS, get_entity_schema
+from sync_state import SyncState
 
-def api_get(domain, api_key, path, params={}):
-    url = "https://{}/api/v2/{}".format(domain, path)
-    rv = requests.get(url, auth=(api_key, ""), params=params)
-    if rv.status_code >= 400:
-        raise Exception(
-            "Server returned status {}. Response:\n{}".format(
-                rv.status_code, json.dumps(rv.json())
-            )
+# The largest page size the List Custom Entities endpoint accepts
+MAX_PAGE_SIZE = 100
+
+
+def iter_custom_entity_pages(domain, api_key, params, next_token=None):
+    """
+    Yield each page of custom entities matching `params`, following nextToken until the last page.
+
+    While the caller handles one page, the next page is already being fetched in the background.
+
+    :returns: an iterator of (custom entities, nextToken of the following page) tuples.
+        Pass a nextToken back in as `next_token` to continue from that page.
+    """
+    def get_page(next_token):
+        return api_get(
+            domain,
+            api_key,
+            # https://docs.benchling.com/v2/reference#list-custom-entities
+            "custom-entities",
+            params=dict(params, nextToken=next_token),
         )
-    return rv.json()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(get_page, next_token)
+        while next_page is not None:
+            response_json = next_page.result()
+            next_token = response_json["nextToken"]
+            next_page = executor.submit(get_page, next_token) if next_token else None
+            yield response_json["customEntities"], next_token
+
+
+def resume_custom_entity_pages(domain, api_key, params, next_token):
+    """
+    Like iter_custom_entity_pages, but starts over from the first page if `next_token` is rejected,
+    e.g. because it has expired. The first page is fetched right away.
+
+    :returns: the pages, and whether they continue from `next_token`
+    """
+    pages = iter_custom_entity_pages(domain, api_key, params, next_token)
+    resumed = True
+    try:
+        first_page = next(pages)
+    except BadRequestException as e:
+        if e.rv.status_code != 400:
+            raise e
+        print("Could not continue the interrupted sync, starting it over", file=sys.stderr)
+        pages = iter_custom_entity_pages(domain, api_key, params)
+        first_page = next(pages)
+        resumed = False
+    return itertools.chain([first_page], pages), resumed
+
+
+def parse_timestamp(timestamp):
+    # Python 3.7's fromisoformat doesn't accept a "Z" suffix for UTC
+    if timestamp.endswith("Z"):
+        timestamp = timestamp[:-1] + "+00:00"
+    parsed = datetime.datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is None:
+        # The API treats timestamps without a time zone as UTC
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
 
 
+def modified_at_windows(modified_after, end, count):
+    """
+    Split the time after `modified_after` into `count` modifiedAt filters.
+
+    The windows are equally sized up to `end`, and the last one is open-ended so it also catches
+    entities modified while the export runs. The API only supports strict comparisons, so every
+    window after the first starts a microsecond early to include entities modified exactly at its
+    start. Entities that show up in two windows are removed by the caller.
+    """
+    window_size = (end - modified_after) / count
+    starts = [modified_after + window_size * index for index in range(count)]
+    windows = []
+    for index, start in enumerate(starts):
+        if index > 0:
+            start -= datetime.timedelta(microseconds=1)
+        window = "> {}".format(start.isoformat())
+        if index < count - 1:
+            window += " AND < {}".format(starts[index + 1].isoformat())
+        windows.append(window)
+    return windows
+
+
+def iter_sharded_custom_entity_pages(domain, api_key, params, last_sync_timestamp, shard_count):
+    """
+    Yield the same entities as iter_custom_entity_pages, paging through `shard_count` modifiedAt
+    windows concurrently. Since there is no single nextToken to continue from, the tuples yielded
+    always have None as their nextToken.
+
+    Pages are yielded in window order, oldest first, and each window is sorted by modifiedAt, so
+    the output is ordered by modification time. Pages of later windows are held in memory until
+    the earlier windows have been yielded.
+    """
+    if last_sync_timestamp:
+        modified_after = parse_timestamp(last_sync_timestamp)
+    else:
+        # Start just before the least recently modified entity
+        response_json = api_get(
+            domain,
+            api_key,
+            "custom-entities",
+            params=dict(params, pageSize=1, sort="modifiedAt:asc"),
+        )
+        if not response_json["customEntities"]:
+            return
+        oldest_modified_at = response_json["customEntities"][0]["modifiedAt"]
+        modified_after = parse_timestamp(oldest_modified_at) - datetime.timedelta(microseconds=1)
+    windows = modified_at_windows(
+        modified_after, datetime.datetime.now(datetime.timezone.utc), shard_count
+    )
+
+    # Set when the caller stops reading or a window fails, so the other windows stop paging
+    # instead of fetching and buffering the rest of the export
+    stopped = threading.Event()
+
+    def export_window(window, page_queue):
+        try:
+            window_params = dict(params, modifiedAt=window, sort="modifiedAt:asc")
+            for antibodies_json, _ in iter_custom_entity_pages(domain, api_key, window_params):
+                if stopped.is_set():
+                    return
+                page_queue.put(antibodies_json)
+        except Exception:
+            stopped.set()
+            raise
+        finally:
+            page_queue.put(None)
+
+    # An entity modified during the export can move into a later window, so remember the latest
+    # version seen of each entity and skip anything that isn't newer
+    latest_modified_at = {}
+    page_queues = [queue.Queue() for _ in windows]
+    with ThreadPoolExecutor(max_workers=len(windows)) as executor:
+        futures = [
+            executor.submit(export_window, window, page_queue)
+            for window, page_queue in zip(windows, page_queues)
+        ]
+        try:
+            for future, page_queue in zip(futures, page_queues):
+                for antibodies_json in iter(page_queue.get, None):
+                    new_antibodies_json = []
+                    for antibody_json in antibodies_json:
+                        modified_at = parse_timestamp(antibody_json["modifiedAt"])
+                        previous_modified_at = latest_modified_at.get(antibody_json["id"])
+                        if previous_modified_at is None or modified_at > previous_modified_at:
+                            latest_modified_at[antibody_json["id"]] = modified_at
+                            new_antibodies_json.append(antibody_json)
+                    yield new_antibodies_json, None
+                # Raise any error from this window
+                future.result()
+                if stopped.is_set():
+                    # Another window failed, so this one may have stopped early. Raise that
+                    # window's error instead of yielding an incomplete export.
+                    for other_future in futures:
+                        other_future.result()
+        finally:
+            stopped.set()
+
 @click.command()
 @click.option(
     "--domain",
@@ -43,79 +205,216 @@ def api_get(domain, api_key, path, params={}):
         "If not given, this script will export all Antibody entities."
     ),
 )
-def main(domain, api_key, registry_id, antibody_schema_id, last_sync_timestamp):
+@click.option(
+    "--max-requests-per-second",
+    help="Client-side limit on API requests per second; set this to your tenant's API quota",
+    type=click.FloatRange(min=0.01),
+    default=api_client.DEFAULT_MAX_REQUESTS_PER_SECOND,
+    show_default=True,
+)
+@click.option(
+    "--page-size",
+    help="Number of entities to request per page",
+    type=click.IntRange(min=1, max=MAX_PAGE_SIZE),
+    default=MAX_PAGE_SIZE,
+    show_default=True,
+)
+@click.option(
+    "--shards",
+    help=(
+        "Split the export into this many modifiedAt time windows and page through them in parallel. "
+        "Rows are then ordered from least to most recently modified."
+    ),
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+)
+@click.option(
+    "--state-file",
+    help=(
+        "JSON file to keep sync progress in. Each run exports the changes since the previous run "
+        "recorded in this file, and an interrupted run continues from the last page it wrote. "
+        "--last-sync-timestamp overrides the timestamp recorded in the file."
+    ),
+    type=click.Path(dir_okay=False),
+)
+@click.option(
+    "--schema-cache-file",
+    help="JSON file to cache entity schemas in, so repeated runs don't have to download them",
+    type=click.Path(dir_okay=False),
+)
+@click.option(
+    "--schema-cache-ttl",
+    help="Seconds a cached schema is used before checking whether it has changed",
+    type=click.IntRange(min=0),
+    default=DEFAULT_TTL_SECONDS,
+    show_default=True,
+)
+@click.option(
+    "--output-format",
+    help="Format to export in. Parquet and Arrow need the pyarrow package.",
+    type=click.Choice(OUTPUT_FORMATS),
+    default="csv",
+    show_default=True,
+)
+@click.option(
+    "--compression",
+    help=(
+        "Compression for the output (zstd needs the zstandard package for CSV and JSON Lines). "
+        "Parquet uses snappy when this is none, and Arrow only supports zstd."
+    ),
+    type=click.Choice(COMPRESSIONS),
+    default="none",
+    show_default=True,
+)
+@click.option(
+    "--output",
+    help="File to write to. CSV and JSON Lines are written to standard output if this is omitted.",
+    type=click.Path(dir_okay=False),
+)
+def main(
+    domain,
+    api_key,
+    registry_id,
+    antibody_schema_id,
+    last_sync_timestamp,
+    max_requests_per_second,
+    page_size,
+    shards,
+    state_file,
+    schema_cache_file,
+    schema_cache_ttl,
+    output_format,
+    compression,
+    output,
+):
     """Export registered Antibody entities that were modified after the given timestamp.
     
-    The entities are exported as a CSV and printed to standard output. 
+    By default, the entities are exported as a CSV and printed to standard output. 
 
     Example output:
 
     Registry ID,Name,Last Modified At,Heavy Chain,Light Chain
 TA003,AB-BRCA2-003,2019-06-27T20:58:21.225189+00:00,Heavy Chain for AB-BRCA2-002,Light Chain for AB-BRCA2-003
     """
+    validate_output_options(output_format, compression, output)
+    api_client.configure(max_requests_per_second=max_requests_per_second, pool_size=shards + 1)
+
     # Get ordered field names so we can keep the CSV columns in a consistent order
-    all_schemas_json = api_get(
+    antibody_schema_json = get_entity_schema(
         domain,
         api_key,
-        # https://docs.benchling.com/v2/reference#list-entity-schemas
-        "registries/{registry_id}/entity-schemas".format(registry_id=registry_id),
-    )["entitySchemas"]
-    [antibody_schema_json] = [
-        schema_json
-        for schema_json in all_schemas_json
-        if schema_json["id"] == antibody_schema_id
-    ]
+        registry_id,
+        antibody_schema_id,
+        cache_path=schema_cache_file,
+        ttl_seconds=schema_cache_ttl,
+    )
     antibody_field_names = [
         field_definition_json["name"]
         for field_definition_json in antibody_schema_json["fieldDefinitions"]
     ]
 
-    # Get all modified Antibody entities. There may be multiple pages,
-    # so we need to keep calling the API until all entities have been returned.
-    newly_modified_antibodies_json = []
-    next_token = None
-    while True:
-        response_json = api_get(
-            domain,
-            api_key,
-            # https://docs.benchling.com/v2/reference#list-custom-entities
-            "custom-entities",
-            params={
-                "registryId": registry_id,
-                "schemaId": antibody_schema_id,
-                "modifiedAt": (
-                    "> {timestamp}".format(timestamp=last_sync_timestamp)
-                    if last_sync_timestamp
-                    else None
-                ),
-                "nextToken": next_token,
-            },
+    # Get all modified Antibody entities. There may be multiple pages, so we keep
+    # calling the API until all entities have been returned, writing each page as it arrives.
+    state = None
+    resume_token = None
+    resume_at = None
+    max_modified_at = None
+    if state_file:
+        state = SyncState(state_file, "{}/{}".format(registry_id, antibody_schema_id))
+        if last_sync_timestamp is None:
+            last_sync_timestamp = state.last_sync_timestamp
+        in_progress = state.in_progress
+        if in_progress:
+            # The pages written before the interruption must still be in the output, or their
+            # entities would be lost once the watermark moves past them
+            if (
+                shards == 1
+                and in_progress["modifiedAfter"] == last_sync_timestamp
+                and can_resume_output(output_format, compression, output)
+                and in_progress.get("output") == os.path.abspath(output)
+                and in_progress.get("outputSize") is not None
+                and os.path.exists(output)
+                and os.path.getsize(output) >= in_progress["outputSize"]
+            ):
+                print("Continuing the interrupted sync", file=sys.stderr)
+                resume_token = in_progress["nextToken"]
+                resume_at = in_progress["outputSize"]
+                max_modified_at = in_progress["maxModifiedAt"]
+            else:
+                print(
+                    "Starting the interrupted sync over, since its output can't be continued",
+                    file=sys.stderr,
+                )
+                state.clear_in_progress()
+    # Only a plain CSV or JSON Lines file can be continued after an interruption
+    checkpoint_output = (
+        state is not None and shards == 1 and can_resume_output(output_format, compression, output)
+    )
+
+    params = {
+        "registryId": registry_id,
+        "schemaId": antibody_schema_id,
+        "pageSize": page_size,
+    }
+    if shards > 1:
+        pages = iter_sharded_custom_entity_pages(
+            domain, api_key, params, last_sync_timestamp, shards
         )
-        newly_modified_antibodies_json += response_json["customEntities"]
-        next_token = response_json["nextToken"]
-        if not next_token:
-            break
-
-    # Write the CSV
-    writer = csv.DictWriter(
-        sys.stdout,
-        fieldnames=["Registry ID", "Name", "Last Modified At"] + antibody_field_names,
+    else:
+        params["modifiedAt"] = (
+            "> {timestamp}".format(timestamp=last_sync_timestamp)
+            if last_sync_timestamp
+            else None
+        )
+        if resume_token:
+            pages, resumed = resume_custom_entity_pages(domain, api_key, params, resume_token)
+            if not resumed:
+                resume_at = None
+                max_modified_at = None
+        else:
+            pages = iter_custom_entity_pages(domain, api_key, params)
+
+    writer = open_output_writer(
+        output_format,
+        compression,
+        output,
+        ["Registry ID", "Name", "Last Modified At"] + antibody_field_names,
+        resume_at=resume_at,
     )
-    writer.writeheader()
-    for antibody_json in newly_modified_antibodies_json:
-        csv_row_json = {
-            "Registry ID": antibody_json["entityRegistryId"],
-            "Name": antibody_json["name"],
-            "Last Modified At": antibody_json["modifiedAt"],
-        }
-        csv_row_json.update(
-            {
-                field_name: antibody_json["fields"][field_name]["textValue"]
-                for field_name in antibody_field_names
-            }
+    for antibodies_json, next_token in pages:
+        writer.write_rows(
+            antibody_row(antibody_json, antibody_field_names) for antibody_json in antibodies_json
         )
-        writer.writerow(csv_row_json)
+        for antibody_json in antibodies_json:
+            if max_modified_at is None or (
+                parse_timestamp(antibody_json["modifiedAt"]) > parse_timestamp(max_modified_at)
+            ):
+                max_modified_at = antibody_json["modifiedAt"]
+        if checkpoint_output and next_token:
+            state.checkpoint(
+                last_sync_timestamp,
+                next_token,
+                max_modified_at,
+                output=os.path.abspath(output),
+                output_size=writer.tell(),
+            )
+    writer.close()
+
+    if state is not None:
+        state.complete(max_modified_at or last_sync_timestamp)
 
 
+def antibody_row(antibody_json, antibody_field_names):
+    """Return the values to export for an antibody, in the same order as the output columns."""
+    return [
+        antibody_json["entityRegistryId"],
+        antibody_json["name"],
+        antibody_json["modifiedAt"],
+    ] + [
+        antibody_json["fields"][field_name]["textValue"]
+        for field_name in antibody_field_names
+    ]
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,62 @@
+import json
+import os
+
+
+class SyncState:
+    """
+    Progress of scheduled syncs, persisted as a JSON file so each run only exports the changes
+    since the previous one.
+
+    Several registries and schemas can share one state file; each sync only touches the entry
+    for its own `key`. The entry holds:
+    - lastSyncTimestamp: the most recent modifiedAt exported by the last completed sync
+    - inProgress: for a sync that hasn't finished, the lastSyncTimestamp it started from, the
+      nextToken of the first page not yet written, the most recent modifiedAt written so far, and
+      the output file and its size after the last page written, if the output can be continued
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self._states = {}
+        if os.path.exists(path):
+            with open(path) as state_file:
+                self._states = json.load(state_file)
+
+    @property
+    def last_sync_timestamp(self):
+        return self._states.get(self.key, {}).get("lastSyncTimestamp")
+
+    @property
+    def in_progress(self):
+        return self._states.get(self.key, {}).get("inProgress")
+
+    def checkpoint(self, modified_after, next_token, max_modified_at, output=None, output_size=None):
+        """
+        Record a page as written, so an interrupted sync can continue from `next_token`, appending
+        to `output` from `output_size` bytes.
+        """
+        state = self._states.setdefault(self.key, {})
+        state["inProgress"] = {
+            "modifiedAfter": modified_after,
+            "nextToken": next_token,
+            "maxModifiedAt": max_modified_at,
+            "output": output,
+            "outputSize": output_size,
+        }
+        self._save()
+
+    def clear_in_progress(self):
+        """Forget an interrupted sync, so that it starts over from lastSyncTimestamp."""
+        self._states.get(self.key, {}).pop("inProgress", None)
+        self._save()
+
+    def complete(self, last_sync_timestamp):
+        self._states[self.key] = {"lastSyncTimestamp": last_sync_timestamp}
+        self._save()
+
+    def _save(self):
+        temp_path = "{}.tmp".format(self.path)
+        with open(temp_path, "w") as state_file:
+            json.dump(self._states, state_file, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,68 @@
+# Reads a .csv file in batches of columns rather than rows, so that numeric columns can be
+# converted with NumPy in one call per column instead of one float() call per value.
+import csv
+import itertools
+from collections import namedtuple
+
+import numpy as np
+
+# line_numbers holds the line in the file of each row in the columns, a list with a tuple of values
+# for each heading. malformed is a list of (line number, message) for rows that were left out.
+ColumnBatch = namedtuple(
+    "ColumnBatch", ["first_line", "last_line", "line_numbers", "columns", "malformed"]
+)
+
+
+class ColumnarCsvReader:
+    def __init__(self, csvfile, batch_size):
+        self._reader = csv.reader(csvfile)
+        self.headings = next(self._reader, [])
+        self._batch_size = batch_size
+
+    def __iter__(self):
+        while True:
+            first_line = self._reader.line_num + 1
+            line_numbers = []
+            rows = []
+            malformed = []
+            for row in itertools.islice(self._reader, self._batch_size):
+                if not row:
+                    continue
+                if len(row) != len(self.headings):
+                    malformed.append(
+                        (
+                            self._reader.line_num,
+                            "has {} values instead of {}".format(len(row), len(self.headings)),
+                        )
+                    )
+                    continue
+                line_numbers.append(self._reader.line_num)
+                rows.append(row)
+            last_line = self._reader.line_num
+            if last_line < first_line:
+                return
+            columns = list(zip(*rows)) if rows else [()] * len(self.headings)
+            yield ColumnBatch(first_line, last_line, line_numbers, columns, malformed)
+
+
+def parse_float_column(values):
+    """
+    Convert a column of strings to floats.
+
+    :returns: the float values, and None if they are all finite numbers, or else a boolean array
+        that is False for the values that aren't
+    """
+    try:
+        floats = np.array(values, dtype=str).astype(np.float64)
+    except ValueError:
+        # Only columns with malformed values are converted one value at a time, to find them
+        floats = np.full(len(values), np.nan)
+        for index, value in enumerate(values):
+            try:
+                floats[index] = float(value)
+            except ValueError:
+                pass
+    is_finite = np.isfinite(floats)
+    if is_finite.all():
+        return floats, None
+    return floats, is_finite
@@ -0,0 +1,188 @@
+# Maps the columns of a .csv file to the fields of a result schema, as described by a mapping file
+# like plate_reader_mapping.json:
+#
+# {
+#     "runField": "run",
+#     "fields": {
+#         "sample": {"column": "Sample", "type": "text"},
+#         "signal": {"column": "Signal", "type": "float", "scale": 0.001, "offset": 0}
+#     }
+# }
+#
+# "runField" is the result field that links to the run. Each entry of "fields" maps a result
+# field to a column of the .csv file, and gives the type to convert the column's values to: "text",
+# "float" or "integer". Float values can also be converted to another unit, as value * scale + offset.
+import json
+
+import click
+import numpy as np
+
+from api_client import api_get
+from columnar_csv import parse_float_column
+
+FIELD_TYPES = ("text", "float", "integer")
+# Result schema field types that can be set from each type of numeric column. Text columns can set
+# any field that isn't numeric.
+SCHEMA_TYPES = {"float": {"float"}, "integer": {"integer", "float"}}
+NUMERIC_SCHEMA_TYPES = {"float", "integer"}
+INVALID_VALUE_MESSAGES = {"float": "is not a number", "integer": "is not a whole number"}
+
+
+def load_mapping(path):
+    """Read a mapping file, and check that it is well-formed."""
+    with open(path) as mapping_file:
+        mapping = json.load(mapping_file)
+    problems = []
+    if not isinstance(mapping.get("runField"), str):
+        problems.append('"runField" must be the name of the result field that links to the run')
+    if not isinstance(mapping.get("fields"), dict) or not mapping["fields"]:
+        problems.append('"fields" must map result fields to columns')
+    else:
+        for field_name, field_mapping in mapping["fields"].items():
+            if not isinstance(field_mapping.get("column"), str):
+                problems.append('{}: "column" must be a column heading'.format(field_name))
+            field_type = field_mapping.get("type")
+            if field_type not in FIELD_TYPES:
+                problems.append('{}: "type" must be one of {}'.format(field_name, ", ".join(FIELD_TYPES)))
+            for key in ("scale", "offset"):
+                if key not in field_mapping:
+                    continue
+                if field_type != "float":
+                    problems.append('{}: "{}" can only be used with float columns'.format(field_name, key))
+                elif not isinstance(field_mapping[key], (int, float)):
+                    problems.append('{}: "{}" must be a number'.format(field_name, key))
+    if problems:
+        raise click.ClickException("Invalid mapping file {}:\n{}".format(path, "\n".join(problems)))
+    return mapping
+
+
+def check_mapping_against_schema(domain, api_key, result_schema_id, mapping):
+    """
+    Check that every mapped field exists in the result schema with a compatible type, and that
+    every required field is mapped.
+    """
+    # https://docs.benchling.com/reference#get-result-schema
+    schema = api_get(domain, api_key, "assay-result-schemas/{}".format(result_schema_id))
+    schema_fields = {field["name"]: field for field in schema["fieldDefinitions"]}
+    problems = []
+    if mapping["runField"] not in schema_fields:
+        problems.append("The run field {} is not in the result schema".format(mapping["runField"]))
+    for field_name, field_mapping in mapping["fields"].items():
+        schema_field = schema_fields.get(field_name)
+        if schema_field is None:
+            problems.append("{} is not a field of the result schema".format(field_name))
+            continue
+        allowed_schema_types = SCHEMA_TYPES.get(field_mapping["type"])
+        if allowed_schema_types is None:
+            is_compatible = schema_field["type"] not in NUMERIC_SCHEMA_TYPES
+        else:
+            is_compatible = schema_field["type"] in allowed_schema_types
+        if not is_compatible:
+            problems.append(
+                "{} is a {} field, so it can't be set from a column of type {}".format(
+                    field_name, schema_field["type"], field_mapping["type"]
+                )
+            )
+    for field_name, schema_field in schema_fields.items():
+        if (
+            schema_field.get("isRequired")
+            and field_name not in mapping["fields"]
+            and field_name != mapping["runField"]
+        ):
+            problems.append("{} is a required field of the result schema, but isn't mapped".format(field_name))
+    if problems:
+        raise click.ClickException(
+            "The mapping doesn't match result schema {}:\n{}".format(result_schema_id, "\n".join(problems))
+        )
+
+
+def text_converter(values):
+    return values, None
+
+
+def float_converter(scale, offset):
+    def convert(values):
+        floats, is_valid = parse_float_column(values)
+        if scale != 1 or offset != 0:
+            floats = floats * scale + offset
+        return floats.tolist(), is_valid
+
+    return convert
+
+
+def integer_converter(values):
+    floats, is_valid = parse_float_column(values)
+    is_integer = np.floor(floats) == floats
+    if not is_integer.all():
+        is_valid = is_integer if is_valid is None else is_valid & is_integer
+    if is_valid is not None:
+        floats = np.where(is_valid, floats, 0)
+    return floats.astype(np.int64).tolist(), is_valid
+
+
+class ResultConverter:
+    """
+    A mapping compiled for the headings of one .csv file: converts batches of columns to the fields
+    of result objects.
+    """
+
+    def __init__(self, mapping, headings):
+        missing_columns = sorted(
+            {field_mapping["column"] for field_mapping in mapping["fields"].values()} - set(headings)
+        )
+        if missing_columns:
+            raise click.ClickException("Missing .csv columns: {}".format(missing_columns))
+        self.run_field = mapping["runField"]
+        self.field_names = tuple(mapping["fields"])
+        self.column_indexes = tuple(
+            headings.index(field_mapping["column"]) for field_mapping in mapping["fields"].values()
+        )
+        self.headings = tuple(field_mapping["column"] for field_mapping in mapping["fields"].values())
+        self.invalid_value_messages = tuple(
+            INVALID_VALUE_MESSAGES.get(field_mapping["type"]) for field_mapping in mapping["fields"].values()
+        )
+        self.converters = tuple(
+            self._compile_converter(field_mapping) for field_mapping in mapping["fields"].values()
+        )
+
+    @staticmethod
+    def _compile_converter(field_mapping):
+        if field_mapping["type"] == "float":
+            return float_converter(field_mapping.get("scale", 1), field_mapping.get("offset", 0))
+        if field_mapping["type"] == "integer":
+            return integer_converter
+        return text_converter
+
+    def convert(self, run_id, batch):
+        """
+        Convert a batch of .csv rows to the fields of result objects. Rows with a value that can't
+        be converted are left out.
+
+        :returns: the fields for each well-formed row, and (line number, message) for each
+            malformed one
+        """
+        malformed = list(batch.malformed)
+        is_valid_row = np.ones(len(batch.line_numbers), dtype=bool)
+        converted_columns = []
+        for column_index, converter, heading, invalid_value_message in zip(
+            self.column_indexes, self.converters, self.headings, self.invalid_value_messages
+        ):
+            column = batch.columns[column_index]
+            values, is_valid_value = converter(column)
+            if is_valid_value is not None:
+                for index in np.flatnonzero(~is_valid_value):
+                    malformed.append(
+                        (
+                            batch.line_numbers[index],
+                            "{} {}: {!r}".format(heading, invalid_value_message, column[index]),
+                        )
+                    )
+                is_valid_row &= is_valid_value
+            converted_columns.append(values)
+        malformed.sort()
+
+        field_names = self.field_names + (self.run_field,)
+        rows = zip(*converted_columns, [run_id] * len(is_valid_row))
+        if malformed:
+            rows = (row for row, is_valid in zip(rows, is_valid_row.tolist()) if is_valid)
+        return [dict(zip(field_names, row)) for row in rows], malformed
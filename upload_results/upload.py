@@ -1,36 +1,26 @@
-# This script parses a .csv file of results, and creates corresponding
+# This script parses .csv files of results, and creates corresponding
 # result objects in Benchling.
 import csv
-import json
-import sys
+import glob
+import hashlib
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 import requests
 
+import api_client
+from api_client import BadRequestException, api_post
+from columnar_csv import ColumnarCsvReader
+from result_mapping import ResultConverter, check_mapping_against_schema, load_mapping
+from upload_ledger import UploadLedger
 
-def api_get(domain, api_key, path):
-    url = "https://{}/api/v2/{}".format(domain, path)
-    rv = requests.get(url, auth=(api_key, ""))
-    if rv.status_code >= 400:
-        raise Exception(
-            "Server returned status {}. Response:\n{}".format(
-                rv.status_code, json.dumps(rv.json())
-            )
-        )
-    return rv.json()
-
-
-def api_post(domain, api_key, path, body):
-    url = "https://{}/api/v2/{}".format(domain, path)
-    rv = requests.post(url, json=body, auth=(api_key, ""))
-    if rv.status_code >= 400:
-        raise Exception(
-            "Server returned status {}. Response:\n{}".format(
-                rv.status_code, json.dumps(rv.json())
-            )
-        )
-    return rv.json()
-
+# Number of runs created with each assay-runs request when uploading a directory
+RUNS_PER_REQUEST = 100
+# Errors that stop a single file from being uploaded, without stopping the others
+FILE_ERRORS = (BadRequestException, requests.RequestException, csv.Error, UnicodeDecodeError, OSError)
 
 @click.command()
 @click.option(
@@ -41,70 +31,400 @@ def api_post(domain, api_key, path, body):
 @click.option("--api-key", help="Your API key", required=True)
 @click.option("--run-schema-id", help="ID of run schema", required=True)
 @click.option("--result-schema-id", help="ID of result schema", required=True)
-def main(domain, api_key, run_schema_id, result_schema_id):
-    csv_results = []
+@click.option(
+    "--max-requests-per-second",
+    help="Client-side limit on API requests per second; set this to your tenant's API quota",
+    type=click.FloatRange(min=0.01),
+    default=api_client.DEFAULT_MAX_REQUESTS_PER_SECOND,
+    show_default=True,
+)
+@click.option(
+    "--batch-size",
+    help="Number of results to upload in each request",
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+)
+@click.option(
+    "--concurrency",
+    help="Number of batches of results to upload in parallel for each file",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+)
+@click.option(
+    "--csv-file",
+    help="The .csv file of results to upload",
+    type=click.Path(dir_okay=False),
     # "plate_reader_data.csv" is the name of our example .csv file
-    # This can be changed to match the name of the .csv file you are using
-    with open("plate_reader_data.csv") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            csv_results.append(dict(row))
-
-    for csv_result in csv_results:
-        assert set(csv_result.keys()) == set(
-            # The following are the headings of the columns in our example .csv file
-            # This can be changed to match the headings in the .csv file you are using
-            [
-                "Sample",
-                "Well",
-                "Signal",
-                "Mean",
-                "CV",
-                "Calc. Concentration",
-                "Calc. Conc. Mean",
-                "Calc. Conc. CV",
-            ]
+    default="plate_reader_data.csv",
+    show_default=True,
+)
+@click.option(
+    "--mapping-file",
+    help="JSON file that maps the columns of the .csv files to fields of the result schema",
+    type=click.Path(exists=True, dir_okay=False),
+    # "plate_reader_mapping.json" maps the columns of our example .csv file to the fields of the
+    # results schema used in our example
+    default="plate_reader_mapping.json",
+    show_default=True,
+)
+@click.option(
+    "--directory",
+    help="Upload every file in this directory that matches --pattern, each to its own run, instead of --csv-file",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--pattern",
+    help="Glob pattern of .csv files to upload from --directory",
+    default="*.csv",
+    show_default=True,
+)
+@click.option(
+    "--file-concurrency",
+    help="Number of files to upload in parallel from --directory",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+)
+@click.option(
+    "--ledger-file",
+    help=(
+        "Ledger of the files uploaded from --directory, used to never upload a file twice "
+        "(defaults to .upload_ledger.json in the directory)"
+    ),
+)
+@click.option(
+    "--watch",
+    help="Keep checking --directory for new files, instead of exiting after uploading the current ones",
+    is_flag=True,
+)
+@click.option(
+    "--poll-interval",
+    help="Seconds between checks of --directory for new files when using --watch",
+    type=click.FloatRange(min=0.01),
+    default=30,
+    show_default=True,
+)
+def main(
+    domain,
+    api_key,
+    run_schema_id,
+    result_schema_id,
+    max_requests_per_second,
+    batch_size,
+    concurrency,
+    csv_file,
+    mapping_file,
+    directory,
+    pattern,
+    file_concurrency,
+    ledger_file,
+    watch,
+    poll_interval,
+):
+    mapping = load_mapping(mapping_file)
+    if directory is None:
+        api_client.configure(max_requests_per_second=max_requests_per_second, pool_size=concurrency)
+        check_mapping_against_schema(domain, api_key, result_schema_id, mapping)
+        with open(csv_file, newline="") as csvfile:
+            ResultConverter(mapping, read_headings(csvfile))
+        [run_id] = create_runs(domain, api_key, run_schema_id, 1)
+        uploaded_count, failed_batch_count, malformed_row_count = upload_csv_file(
+            domain, api_key, result_schema_id, mapping, run_id, csv_file, batch_size, concurrency
+        )
+        print("Uploaded {} results to run {}".format(uploaded_count, run_id))
+        if failed_batch_count or malformed_row_count:
+            raise click.ClickException(
+                "{} batches failed to upload, and {} malformed rows were skipped".format(
+                    failed_batch_count, malformed_row_count
+                )
+            )
+        return
+
+    api_client.configure(
+        max_requests_per_second=max_requests_per_second,
+        pool_size=file_concurrency * concurrency,
+    )
+    check_mapping_against_schema(domain, api_key, result_schema_id, mapping)
+    if ledger_file is None:
+        ledger_file = os.path.join(directory, ".upload_ledger.json")
+    ledger = UploadLedger(ledger_file)
+    # Path -> (size, modification time, MD5), so unchanged files aren't read again on every check.
+    # The MD5 is None for files that can't be read or have the wrong headings.
+    file_md5s = {}
+    while True:
+        try:
+            failed_file_count = upload_directory(
+                domain,
+                api_key,
+                run_schema_id,
+                result_schema_id,
+                mapping,
+                directory,
+                pattern,
+                ledger,
+                file_md5s,
+                batch_size,
+                concurrency,
+                file_concurrency,
+                # Files modified since the last check may still be being written
+                settle_seconds=poll_interval if watch else 0,
+            )
+        except Exception as e:
+            if not watch:
+                raise
+            # A problem during one check, such as a dropped connection, shouldn't stop the
+            # watcher. Anything left unfinished is picked up again by the next check.
+            print("Could not finish checking {}, trying again in {} seconds:\n{!r}".format(
+                directory, poll_interval, e
+            ))
+        if not watch:
+            if failed_file_count:
+                raise click.ClickException("{} files could not be uploaded".format(failed_file_count))
+            return
+        time.sleep(poll_interval)
+
+
+def upload_directory(
+    domain,
+    api_key,
+    run_schema_id,
+    result_schema_id,
+    mapping,
+    directory,
+    pattern,
+    ledger,
+    file_md5s,
+    batch_size,
+    concurrency,
+    file_concurrency,
+    settle_seconds=0,
+):
+    """
+    Upload every file in `directory` matching `pattern` that isn't complete in the ledger.
+
+    Runs for new files are created together, then the files are uploaded `file_concurrency` at a
+    time. Files that were interrupted continue in their existing run.
+
+    :returns: the number of files that couldn't be completely uploaded
+    """
+    new_files = []
+    new_md5s = set()
+    unfinished_files = []
+    now = time.time()
+    for path in sorted(glob.glob(os.path.join(directory, pattern))):
+        if not os.path.isfile(path) or os.path.abspath(path).startswith(os.path.abspath(ledger.path)):
+            continue
+        stat = os.stat(path)
+        if now - stat.st_mtime < settle_seconds:
+            continue
+        cached = file_md5s.get(path)
+        if cached is None or cached[:2] != (stat.st_size, stat.st_mtime):
+            # Problems are only reported once, rather than on every check of the directory
+            try:
+                md5 = calculate_file_md5(path)
+                with open(path, newline="") as csvfile:
+                    ResultConverter(mapping, read_headings(csvfile))
+            except click.ClickException as e:
+                print("Skipping {}: {}".format(path, e.message))
+                md5 = None
+            except (csv.Error, UnicodeDecodeError, OSError) as e:
+                print("Skipping {}: {!r}".format(path, e))
+                md5 = None
+            cached = (stat.st_size, stat.st_mtime, md5)
+            file_md5s[path] = cached
+        md5 = cached[2]
+        if md5 is None:
+            continue
+        entry = ledger.get(md5)
+        if entry is None or entry["runId"] is None:
+            if entry is not None:
+                print(
+                    "A run may already have been created for {} before an earlier attempt was "
+                    "interrupted; creating another one. Check for an empty run.".format(path)
+                )
+            # Identical files in the same directory are only uploaded once
+            if md5 not in new_md5s:
+                new_md5s.add(md5)
+                new_files.append((path, md5))
+        elif not entry["complete"]:
+            unfinished_files.append((path, md5))
+    if not new_files and not unfinished_files:
+        return 0
+
+    for start in range(0, len(new_files), RUNS_PER_REQUEST):
+        files = new_files[start:start + RUNS_PER_REQUEST]
+        # Recorded first, so that runs created by a request that is interrupted aren't forgotten
+        ledger.add_pending([(md5, os.path.basename(path)) for path, md5 in files], batch_size)
+        run_ids = create_runs(domain, api_key, run_schema_id, len(files))
+        ledger.assign_runs([md5 for _, md5 in files], run_ids)
+
+    def upload_unfinished_file(path, md5):
+        entry = ledger.get(md5)
+        counts = upload_csv_file(
+            domain,
+            api_key,
+            result_schema_id,
+            mapping,
+            entry["runId"],
+            path,
+            entry["batchSize"],
+            concurrency,
+            uploaded_batches=set(entry["uploadedBatches"]),
+            on_batch_uploaded=lambda first_line: ledger.record_batch(md5, first_line),
         )
+        if counts[1] == 0:
+            ledger.complete(md5)
+        return entry["runId"], counts
+
+    files = unfinished_files + new_files
+    failed_file_count = 0
+    with ThreadPoolExecutor(max_workers=file_concurrency) as executor:
+        futures = [(path, executor.submit(upload_unfinished_file, path, md5)) for path, md5 in files]
+        for path, future in futures:
+            try:
+                run_id, (uploaded_count, failed_batch_count, malformed_row_count) = future.result()
+            except FILE_ERRORS as e:
+                print("Could not upload {}:\n{}".format(path, e))
+                failed_file_count += 1
+                continue
+            print(
+                "Uploaded {} results from {} to run {} ({} batches failed, {} malformed rows skipped)".format(
+                    uploaded_count, path, run_id, failed_batch_count, malformed_row_count
+                )
+            )
+            if failed_batch_count:
+                failed_file_count += 1
+    print("Finished {} of {} files from {}".format(len(files) - failed_file_count, len(files), directory))
+    return failed_file_count
 
+
+def create_runs(domain, api_key, run_schema_id, count):
+    """
+    Create `count` runs with a single request.
+
+    :returns: the IDs of the new runs
+    """
     response = api_post(
         domain,
         api_key,
         "assay-runs",
-        {"assayRuns": [{"schemaId": run_schema_id, "fields": {}}]},
+        {"assayRuns": [{"schemaId": run_schema_id, "fields": {}} for _ in range(count)]},
     )
-    [run_id] = response["assayRuns"]
+    return response["assayRuns"]
+
 
+def upload_csv_file(
+    domain,
+    api_key,
+    result_schema_id,
+    mapping,
+    run_id,
+    path,
+    batch_size,
+    concurrency,
+    uploaded_batches=(),
+    on_batch_uploaded=None,
+):
+    """
+    Upload the results in a .csv file to a run, `concurrency` batches at a time, converting its
+    rows to results as described by `mapping`.
+
+    :param uploaded_batches: first lines of batches that were already uploaded, which are skipped
+    :param on_batch_uploaded: called with the first line of each batch once it's uploaded
+    :returns: the number of results uploaded, of batches that failed, and of malformed rows
+    """
+    name = os.path.basename(path)
+    uploaded_count = 0
+    failed_batch_count = 0
+    malformed_row_count = 0
+
+    def report(batch_number, batch, future):
+        nonlocal uploaded_count, failed_batch_count, malformed_row_count
+        uploaded, failed, malformed = report_batch(name, batch_number, batch, future)
+        uploaded_count += uploaded
+        failed_batch_count += failed
+        malformed_row_count += malformed
+        if not failed and on_batch_uploaded is not None:
+            on_batch_uploaded(batch.first_line)
+
+    with open(path, newline="") as csvfile:
+        reader = ColumnarCsvReader(csvfile, batch_size)
+        converter = ResultConverter(mapping, reader.headings)
+        # The file is read one batch at a time while earlier batches upload, so that at most
+        # `concurrency` batches are in memory at once
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            in_flight = deque()
+            for batch_number, batch in enumerate(reader, start=1):
+                if batch.first_line in uploaded_batches:
+                    continue
+                if len(in_flight) >= concurrency:
+                    report(*in_flight.popleft())
+                future = executor.submit(
+                    upload_results, domain, api_key, result_schema_id, converter, run_id, batch
+                )
+                in_flight.append((batch_number, batch, future))
+            while in_flight:
+                report(*in_flight.popleft())
+    return uploaded_count, failed_batch_count, malformed_row_count
+
+
+def read_headings(csvfile):
+    return next(csv.reader(csvfile), [])
+
+
+def calculate_file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def upload_results(domain, api_key, result_schema_id, converter, run_id, batch):
+    """
+    Upload the well-formed rows of one batch as results.
+
+    :returns: the IDs of the uploaded results, and (line number, message) for each malformed row
+    """
+    fields, malformed = converter.convert(run_id, batch)
+    if not fields:
+        return [], malformed
     response = api_post(
         domain,
         api_key,
         "assay-results",
-        {
-            "assayResults": [
-                {
-                    "schemaId": result_schema_id,
-                    # This maps columns in the results .csv file to fields in a Benchling result object
-                    # The following is made for the .csv file and results schema used in our example
-                    # These can be changed to match the fields of the results schema you are using
-                    # The keys on the left must match the field name in Benchling
-                    # The keys on the right (being passed into csv_result) must match the column headings
-                    # in your .csv file
-                    "fields": {
-                        "run": run_id,
-                        "sample": csv_result["Sample"],
-                        "well": csv_result["Well"],
-                        "signal": float(csv_result["Signal"]),
-                        "mean": float(csv_result["Mean"]),
-                        "cv": float(csv_result["CV"]),
-                        "calc_concentration": float(csv_result["Calc. Concentration"]),
-                        "calc_conc_mean": float(csv_result["Calc. Conc. Mean"]),
-                        "calc_conc_cv": float(csv_result["Calc. Conc. CV"]),
-                    },
-                }
-                for csv_result in csv_results
-            ]
-        },
+        {"assayResults": [{"schemaId": result_schema_id, "fields": result} for result in fields]},
     )
-    print(response)
+    return response["assayResults"], malformed
+
+
+def report_batch(name, batch_number, batch, future):
+    """
+    Print the outcome of uploading a batch.
+
+    :returns: the number of results uploaded, 1 if the batch failed or else 0, and the number of
+        malformed rows
+    """
+    lines = "lines {}-{}".format(batch.first_line, batch.last_line)
+    try:
+        result_ids, malformed = future.result()
+    except BadRequestException as e:
+        print("{}: could not upload batch {} ({}):\n{}".format(name, batch_number, lines, e))
+        return 0, 1, 0
+    except requests.RequestException as e:
+        # Creating results isn't retried after a dropped connection, since it may have succeeded
+        print(
+            "{}: could not upload batch {} ({}), its results may or may not have been created:\n{!r}".format(
+                name, batch_number, lines, e
+            )
+        )
+        return 0, 1, 0
+    for line_number, message in malformed:
+        print("{}: skipped line {}: {}".format(name, line_number, message))
+    print("{}: uploaded batch {} ({}): {}".format(name, batch_number, lines, result_ids))
+    return len(result_ids), 0, len({line_number for line_number, _ in malformed})
 
 
 if __name__ == "__main__":
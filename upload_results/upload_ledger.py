@@ -0,0 +1,67 @@
+import json
+import os
+import threading
+
+
+class UploadLedger:
+    """
+    Record of the .csv files uploaded from a directory, keyed by the MD5 of their contents, so that
+    restarts never upload the same plate twice.
+
+    Each entry holds the file's name, the run its results are uploaded to, the batch size it is
+    read in, the first lines of the batches uploaded so far, and whether the whole file has been
+    uploaded. The ledger is rewritten after every change, so it survives the process being
+    interrupted, and an interrupted file continues in the same run without re-uploading batches.
+
+    Entries are added before their runs are created, with a runId of None until the runs are
+    assigned, so a run that was created just before the process stopped can still be traced to
+    its file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._files = {}
+        if os.path.exists(path):
+            with open(path) as ledger_file:
+                self._files = json.load(ledger_file)
+
+    def get(self, md5):
+        with self._lock:
+            entry = self._files.get(md5)
+            return dict(entry, uploadedBatches=list(entry["uploadedBatches"])) if entry else None
+
+    def add_pending(self, files, batch_size):
+        """Add an entry without a run for each (MD5, name) in `files`."""
+        with self._lock:
+            for md5, name in files:
+                self._files[md5] = {
+                    "name": name,
+                    "runId": None,
+                    "batchSize": batch_size,
+                    "uploadedBatches": [],
+                    "complete": False,
+                }
+            self._save()
+
+    def assign_runs(self, md5s, run_ids):
+        with self._lock:
+            for md5, run_id in zip(md5s, run_ids):
+                self._files[md5]["runId"] = run_id
+            self._save()
+
+    def record_batch(self, md5, first_line):
+        with self._lock:
+            self._files[md5]["uploadedBatches"].append(first_line)
+            self._save()
+
+    def complete(self, md5):
+        with self._lock:
+            self._files[md5]["complete"] = True
+            self._save()
+
+    def _save(self):
+        temp_path = "{}.tmp".format(self.path)
+        with open(temp_path, "w") as ledger_file:
+            json.dump(self._files, ledger_file, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)